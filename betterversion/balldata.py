@@ -0,0 +1,56 @@
+import json
+import os
+import numpy as np
+
+# File layout: one HEADER_DTYPE header followed by `count` RECORD_DTYPE
+# records, all little-endian, so the records can be memory-mapped in place.
+MAGIC = b"BALLDATA"
+VERSION = 1
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("count", "<u4"),
+                         ("record_size", "<u4"), ("reserved", "<u4")])
+RECORD_DTYPE = np.dtype([("ballNumber", "<i4"), ("radius", "<f4"), ("color", "u1", (4,))])
+
+def write_ball_data(path, ball_numbers, radii, colors):
+    """
+    Write one record per ball. colors may be RGB or RGBA; alpha defaults to 255.
+    The file is written next to path and renamed into place.
+    """
+    colors = np.asarray(colors, dtype=np.uint8)
+    records = np.empty(len(colors), dtype=RECORD_DTYPE)
+    records["ballNumber"] = ball_numbers
+    records["radius"] = radii
+    records["color"][:, 3] = 255
+    records["color"][:, :colors.shape[1]] = colors
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["count"] = len(records)
+    header["record_size"] = RECORD_DTYPE.itemsize
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        header.tofile(f)
+        records.tofile(f)
+    os.replace(tmp_path, path)
+
+def load_ball_data(path):
+    """
+    Memory-map the records of a ball data file without copying them.
+    """
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header["magic"][0] != MAGIC:
+        raise ValueError(f"{path} is not a ball data file")
+    if header["version"][0] != VERSION or header["record_size"][0] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} has unsupported ball data version {header['version'][0]}")
+    count = int(header["count"][0])
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_DTYPE.itemsize, shape=(count,))
+
+def export_json(path, records, indent=2):
+    """
+    Optional human-readable export: a list of {"ballNumber", "color", "radius"}.
+    """
+    ballData = [{"ballNumber": int(r["ballNumber"]), "color": r["color"].tolist(), "radius": float(r["radius"])}
+                for r in records]
+    with open(path, "w") as f:
+        json.dump(ballData, f, indent=indent)
@@ -0,0 +1,280 @@
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import numba
+from physicsengine import allocate_grid, build_grid, update_positions, collision_detection, \
+    collision_detection_parallel, step_frame, choose_substeps, change_substeps
+from rasterizer import draw_circles
+from encoder import FramePipeline, find_ffmpeg
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Benchmark settings
+benchOutput = "benchmark.json"
+benchSizes = [1000, 10000, 50000, 200000]
+benchResolutions = [(640, 360), (1920, 1080), (3840, 2160)]
+benchLayouts = ["packed", "falling"]
+benchSubsteps = 40  # Substeps timed per stage; the median is reported
+benchFrames = 30  # Frames rendered and encoded per configuration
+benchEncode = True  # Also time the FramePipeline encoder
+benchSeed = 0
+packingScene = ("falling", 3000, 640, 360)  # Layout, balls and resolution of the adaptive substepping check
+packingFrames = 300  # Frames the pile is left to settle, with fixed and with adaptive substeps
+packingTolerance = 0.02  # Largest relative difference in packing density that passes
+
+# Physics parameters, same as main.py
+ballRadius = 4
+gravity = 1000
+subSteps = 8
+baseDt = 1 / 60.0
+dt = baseDt / subSteps
+parallelCollisions = True
+minSubSteps = 1
+maxSubSteps = 8
+stepMoveLimit = 1.0
+stepSagLimit = 0.05
+sleepDistance = 1.0
+sleepFrames = 0
+wakeDepth = 1.0
+backgroundColor = (30, 30, 30)
+borderColor = np.array([0, 0, 0], dtype=np.uint8)
+noHiddenPoints = np.zeros((0, 2), dtype=np.float32)
+neverSleep = np.iinfo(np.int32).max
+
+def makeLayout(layout, n, width, height, rng):
+    """
+    Synthetic starting state for n balls. "packed" stacks them on a square
+    lattice from the floor up, slightly overlapping like a settled pile;
+    "falling" scatters them over the screen moving in random directions.
+    Returns (pos, prev, radius), or None when n balls do not fit on screen.
+    """
+    radius = min(ballRadius, 0.5 * math.sqrt(width * height * 0.8 / n))
+    if radius < 1.0:
+        return None
+    if layout == "packed":
+        spacing = 2 * radius * 0.98
+        cols = int(width // spacing)
+        k = np.arange(n)
+        pos = np.empty((n, 2), dtype=np.float32)
+        pos[:, 0] = radius + (k % cols) * spacing + (k // cols % 2) * 0.25 * radius
+        pos[:, 1] = height - radius - (k // cols) * spacing
+        prev = pos.copy()
+    else:
+        pos = np.empty((n, 2), dtype=np.float32)
+        pos[:, 0] = rng.uniform(radius, width - radius, n)
+        pos[:, 1] = rng.uniform(radius, height - radius, n)
+        angle = rng.uniform(0, 2 * math.pi, n)
+        speed = rng.uniform(0, 300, n) * dt
+        prev = pos.copy()
+        prev[:, 0] -= speed * np.cos(angle)
+        prev[:, 1] -= speed * np.sin(angle)
+    return pos, prev, radius
+
+def medianMs(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+def benchPhysics(pos, prev, radii, n, width, height, radius):
+    """
+    Median ms per substep of integration, grid build and collision. The
+    collision stage includes its own grid build, as it does in step_frame.
+    Sleeping is disabled so every ball is worked on every substep.
+    """
+    cellSize = radius * 2
+    cellsX = int(width // cellSize) + 1
+    cellsY = int(height // cellSize) + 1
+    cellIds, cellStart, sortedIdx, cellState = allocate_grid(n, cellsX, cellsY)
+    anchors = pos.copy()
+    still = np.zeros(n, dtype=np.int32)
+    collide = collision_detection_parallel if parallelCollisions else collision_detection
+    return {
+        "integrate_ms": medianMs(lambda: update_positions(pos, prev, radii, anchors, still, n, dt, dt * dt,
+                                                          width, height, gravity, False, 0.0, neverSleep),
+                                 benchSubsteps),
+        "grid_ms": medianMs(lambda: build_grid(pos, n, cellSize, cellsX, cellsY, cellIds, cellStart, sortedIdx),
+                            benchSubsteps),
+        "collision_ms": medianMs(lambda: collide(pos, radii, still, n, neverSleep, 0.0, cellSize, cellsX, cellsY,
+                                                 cellIds, cellStart, sortedIdx, cellState),
+                                 benchSubsteps),
+    }
+
+def benchRender(pos, radii, colors, n, width, height):
+    """
+    Frames per second of draw_circles and, with benchEncode, of the frames
+    going through a FramePipeline into a throwaway video file.
+    """
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def render():
+        frame[:] = backgroundColor
+        draw_circles(frame, pos, radii, colors, n, 1, borderColor, noHiddenPoints)
+
+    result = {"render_fps": 1000.0 / medianMs(render, benchFrames)}
+    if benchEncode:
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = FramePipeline(os.path.join(tmp, "bench.mp4"), width, height)
+            start = time.perf_counter()
+            for _ in range(benchFrames):
+                pipeline.submit(frame)
+            pipeline.close()
+            result["encode_fps"] = benchFrames / (time.perf_counter() - start)
+    return result
+
+def runConfig(layout, n, width, height):
+    rng = np.random.default_rng(benchSeed)
+    tracemalloc.start()
+    state = makeLayout(layout, n, width, height, rng)
+    if state is None:
+        tracemalloc.stop()
+        return {"layout": layout, "balls": n, "resolution": [width, height], "skipped": "does not fit"}
+    pos, prev, radius = state
+    radii = np.full(n, radius, dtype=np.float32)
+    colors = rng.integers(0, 256, (n, 3), dtype=np.uint8)
+    result = {"layout": layout, "balls": n, "resolution": [width, height], "radius": radius}
+    # Rendering first so it sees the initial layout rather than one the physics stages pushed around.
+    result.update(benchRender(pos, radii, colors, n, width, height))
+    result.update(benchPhysics(pos, prev, radii, n, width, height, radius))
+    result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result
+
+def sleepAfter(steps):
+    """
+    Substeps a ball stays put before it sleeps, as main.py derives it.
+    """
+    return sleepFrames * steps if sleepFrames > 0 else neverSleep
+
+def settlePile(layout, n, width, height, frames, adaptive):
+    """
+    Let a layout fall into a pile with the frame kernel main.py uses, with
+    fixed or adaptive substeps. Returns the packing density of the pile (ball
+    area over the area below its top), the mean substeps and ms per frame.
+    """
+    pos, prev, radius = makeLayout(layout, n, width, height, np.random.default_rng(benchSeed))
+    radii = np.full(n, radius, dtype=np.float32)
+    ids = np.arange(n, dtype=np.int32)
+    colors = np.zeros((n, 3), dtype=np.uint8)
+    anchors = pos.copy()
+    still = np.zeros(n, dtype=np.int32)
+    cellSize = radius * 2
+    cellsX = int(width // cellSize) + 1
+    cellsY = int(height // cellSize) + 1
+    cellIds, cellStart, sortedIdx, cellState = allocate_grid(n, cellsX, cellsY)
+    steps = subSteps
+    totalSteps = 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        if adaptive:
+            newSteps = choose_substeps(pos, prev, still, n, sleepAfter(steps), baseDt / steps, baseDt, 0.0, gravity,
+                                       radius, stepMoveLimit * radius, stepSagLimit * radius, minSubSteps, maxSubSteps)
+            if newSteps != steps:
+                change_substeps(pos, prev, still, n, steps, newSteps)
+                steps = newSteps
+        step_frame(pos, prev, radii, ids, colors, anchors, still, n, noHiddenPoints, 0.0, 0.0, 0, 0, colors, steps,
+                   baseDt / steps, width, height, gravity, False, sleepDistance ** 2, sleepAfter(steps), wakeDepth,
+                   cellSize, cellsX, cellsY, cellIds, cellStart, sortedIdx, cellState, parallelCollisions)
+        totalSteps += steps
+    elapsed = time.perf_counter() - start
+    top = np.percentile(pos[:, 1] - radius, 1)
+    return {
+        "packing_density": float(n * math.pi * radius ** 2 / (width * (height - top))),
+        "mean_substeps": totalSteps / frames,
+        "ms_per_frame": elapsed / frames * 1000,
+    }
+
+def benchPacking():
+    """
+    Check that adaptive substepping packs the pile like fixed substeps do.
+    """
+    fixed = settlePile(*packingScene, packingFrames, False)
+    adaptive = settlePile(*packingScene, packingFrames, True)
+    difference = abs(adaptive["packing_density"] - fixed["packing_density"]) / fixed["packing_density"]
+    return {"fixed": fixed, "adaptive": adaptive, "density_difference": difference,
+            "within_tolerance": bool(difference <= packingTolerance)}
+
+def warmup():
+    """
+    Compile every kernel on a tiny scene so JIT time stays out of the numbers.
+    """
+    start = time.perf_counter()
+    state = makeLayout("falling", 64, 64, 64, np.random.default_rng(benchSeed))
+    pos, prev, radius = state
+    radii = np.full(64, radius, dtype=np.float32)
+    benchPhysics(pos, prev, radii, 64, 64, 64, radius)
+    frame = np.empty((64, 64, 3), dtype=np.uint8)
+    draw_circles(frame, pos, radii, np.zeros((64, 3), dtype=np.uint8), 64, 1, borderColor, noHiddenPoints)
+    settlePile("falling", 64, 64, 64, 2, True)
+    return time.perf_counter() - start
+
+def gitRevision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+def maxRssMb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+def main():
+    report = {
+        "revision": gitRevision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "machine": platform.machine(),
+        "threads": numba.get_num_threads(),
+        "parallel_collisions": parallelCollisions,
+        "encoder": "ffmpeg" if find_ffmpeg() is not None else "opencv",
+        "sub_steps": subSteps,
+        "compile_s": warmup(),
+        "results": [],
+    }
+    for width, height in benchResolutions:
+        for n in benchSizes:
+            for layout in benchLayouts:
+                result = runConfig(layout, n, width, height)
+                report["results"].append(result)
+                if "skipped" in result:
+                    print(f"{layout:8s} {n:7d} balls {width}x{height}: skipped ({result['skipped']})")
+                else:
+                    print(f"{layout:8s} {n:7d} balls {width}x{height}: "
+                          f"integrate {result['integrate_ms']:.3f} ms, grid {result['grid_ms']:.3f} ms, "
+                          f"collision {result['collision_ms']:.3f} ms per substep, "
+                          f"render {result['render_fps']:.1f} fps"
+                          + (f", encode {result['encode_fps']:.1f} fps" if "encode_fps" in result else ""))
+    packing = benchPacking()
+    report["adaptive_substeps"] = packing
+    print(f"adaptive substeps: {packing['adaptive']['mean_substeps']:.2f} per frame against {subSteps}, "
+          f"{packing['adaptive']['ms_per_frame']:.2f} ms against {packing['fixed']['ms_per_frame']:.2f} ms per frame, "
+          f"packing density {packing['adaptive']['packing_density']:.4f} against "
+          f"{packing['fixed']['packing_density']:.4f} ({'within' if packing['within_tolerance'] else 'outside'} "
+          f"{packingTolerance:.0%})")
+    report["max_rss_mb"] = maxRssMb()
+    with open(benchOutput, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {benchOutput}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+
+# File layout: one HEADER_DTYPE header, `count` RECORD_DTYPE ball records in
+# slot order, then `palette_count` RGB colours indexed by spawn index. All
+# little-endian, so both arrays can be memory-mapped in place.
+MAGIC = b"BALLCKPT"
+VERSION = 2
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("count", "<u4"), ("palette_count", "<u4"),
+                         ("record_size", "<u4"), ("width", "<u4"), ("height", "<u4"), ("config", "S16"),
+                         ("settled", "u1"), ("mode", "u1"), ("coloring", "u1"), ("recording", "u1"),
+                         ("phase_frame", "<i4"), ("spawn_index", "<i4"), ("original_count", "<i4"),
+                         ("settle_frames", "<i4"), ("calm_frames", "<i4"), ("spawn_timer", "<f8"),
+                         ("sub_steps", "<i4")])
+RECORD_DTYPE = np.dtype([("pos", "<f4", (2,)), ("prev", "<f4", (2,)), ("anchor", "<f4", (2,)), ("radius", "<f4"),
+                         ("id", "<i4"), ("still", "<i4"), ("color", "u1", (4,))])
+
+def write_checkpoint(path, store, n_balls, palette, n_palette, **state):
+    """
+    Save the first n_balls slots of a ParticleStore, the first n_palette
+    palette colours and the scalar state fields named in HEADER_DTYPE.
+    The file is written next to path and renamed into place, so an
+    interrupted save leaves the previous checkpoint intact.
+    """
+    records = np.zeros(n_balls, dtype=RECORD_DTYPE)
+    records["pos"] = store.pos[:n_balls]
+    records["prev"] = store.prev[:n_balls]
+    records["anchor"] = store.anchors[:n_balls]
+    records["radius"] = store.radii[:n_balls]
+    records["id"] = store.ids[:n_balls]
+    records["still"] = store.still[:n_balls]
+    records["color"][:, :3] = store.colors[:n_balls]
+    records["color"][:, 3] = 255
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["count"] = n_balls
+    header["palette_count"] = n_palette
+    header["record_size"] = RECORD_DTYPE.itemsize
+    for key, value in state.items():
+        header[key] = value
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        header.tofile(f)
+        records.tofile(f)
+        np.ascontiguousarray(palette[:n_palette], dtype=np.uint8).tofile(f)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint header and memory-map its ball records and palette.
+    Returns (header, records, palette); header is a single HEADER_DTYPE record.
+    """
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header["magic"][0] != MAGIC:
+        raise ValueError(f"{path} is not a checkpoint file")
+    if header["version"][0] != VERSION or header["record_size"][0] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} has unsupported checkpoint version {header['version'][0]}")
+    count = int(header["count"][0])
+    n_palette = int(header["palette_count"][0])
+    offset = HEADER_DTYPE.itemsize
+    records = np.zeros(0, dtype=RECORD_DTYPE)
+    palette = np.zeros((0, 3), dtype=np.uint8)
+    if count > 0:
+        records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=offset, shape=(count,))
+    if n_palette > 0:
+        palette = np.memmap(path, dtype=np.uint8, mode="r", offset=offset + count * RECORD_DTYPE.itemsize,
+                            shape=(n_palette, 3))
+    return header[0], records, palette
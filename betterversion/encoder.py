@@ -0,0 +1,150 @@
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import numpy as np
+
+def find_ffmpeg():
+    """
+    Path of an ffmpeg binary: the one on PATH, else the one bundled with
+    imageio-ffmpeg, else None.
+    """
+    path = shutil.which("ffmpeg")
+    if path is None:
+        try:
+            import imageio_ffmpeg
+            path = imageio_ffmpeg.get_ffmpeg_exe()
+        except (ImportError, RuntimeError):
+            path = None
+    return path
+
+class FFmpegEncoder:
+    """
+    Streams raw RGB frames to an ffmpeg subprocess over a pipe. Writing to the
+    pipe releases the GIL, so encoding runs fully beside the Python threads.
+    """
+
+    def __init__(self, path, width, height, fps, ffmpeg):
+        self.process = subprocess.Popen(
+            [ffmpeg, "-y", "-loglevel", "error",
+             "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+             "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18",
+             path],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(memoryview(frame))
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with status {self.process.returncode}")
+
+class OpenCVEncoder:
+    """
+    Fallback when no ffmpeg binary is available: the same pipe, to a Python
+    subprocess running this module around cv2.VideoWriter, so that encoding
+    does not compete with the renderer for the GIL.
+    """
+
+    def __init__(self, path, width, height, fps):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), path, str(width), str(height), str(fps)],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(memoryview(frame))
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"OpenCV encoder exited with status {self.process.returncode}")
+
+def encode_stdin(path, width, height, fps):
+    """
+    Write raw RGB frames read from stdin to path with cv2.VideoWriter, until
+    stdin is closed. The OpenCVEncoder end of the pipe.
+    """
+    import cv2
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not out.isOpened():
+        raise RuntimeError(f"cv2.VideoWriter cannot open {path}")
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    try:
+        while sys.stdin.buffer.readinto(memoryview(frame).cast("B")) == frame.nbytes:
+            out.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    finally:
+        out.release()
+
+class FramePipeline:
+    """
+    Bounded hand-off from the renderer to a background encoder thread through
+    a small ring of preallocated (height, width, 3) RGB buffers. submit()
+    blocks while every buffer is waiting to be encoded, so memory stays at
+    `buffers` frames and no frame is lost. With drop_when_full the frame is
+    counted in `dropped` instead of waiting. If the encoder fails, the
+    error is raised from the next submit() or from close().
+    """
+
+    def __init__(self, path, width, height, fps=60, buffers=8, drop_when_full=False):
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is not None:
+            self.encoder = FFmpegEncoder(path, width, height, fps, ffmpeg)
+        else:
+            self.encoder = OpenCVEncoder(path, width, height, fps)
+        self.buffers = np.empty((buffers, height, width, 3), dtype=np.uint8)
+        self.free = queue.Queue()
+        for i in range(buffers):
+            self.free.put(i)
+        self.ready = queue.Queue()
+        self.drop_when_full = drop_when_full
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def submit(self, frame):
+        if self.error is not None:
+            raise self.error
+        try:
+            slot = self.free.get(block=not self.drop_when_full)
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        if self.error is not None:
+            self.free.put(slot)
+            raise self.error
+        np.copyto(self.buffers[slot], frame)
+        self.ready.put(slot)
+        return True
+
+    def _run(self):
+        while True:
+            slot = self.ready.get()
+            if slot is None:
+                break
+            # After a failure frames are discarded, so that submit() never waits on a dead thread
+            if self.error is None:
+                try:
+                    self.encoder.write(self.buffers[slot])
+                    self.written += 1
+                except Exception as e:
+                    self.error = e
+            self.free.put(slot)
+
+    def close(self):
+        self.ready.put(None)
+        self.thread.join()
+        try:
+            self.encoder.close()
+        except Exception:
+            if self.error is None:
+                raise
+        if self.error is not None:
+            raise self.error
+
+if __name__ == "__main__":
+    encode_stdin(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))
@@ -4,243 +4,786 @@ import math
 import random
 import threading
 import time
-import json
 import os
 import hashlib
-import cv2
-import queue
 import shutil
-from physicsengine import update_positions, collision_detection
-from tqdm import tqdm
+import signal
+from physicsengine import allocate_grid, build_grid, reorder_particles, step_frame, motion_stats, spawn_balls, \
+    update_positions, collision_detection, collision_detection_parallel, choose_substeps, change_substeps
+from rasterizer import draw_circles, LayeredRenderer
+from snapshot import SnapshotRing, SharedSnapshotRing
+from particles import ParticleStore, grow_rows
+from sampler import surface_to_array, sample_colors
+from balldata import write_ball_data, load_ball_data, export_json
+from trajectory import config_key, TrajectoryWriter, TrajectoryReader
+from checkpoint import write_checkpoint, load_checkpoint
+from encoder import FramePipeline
+from telemetry import Telemetry, TimedLock
 
 random.seed(42)
 np.random.seed(42)
 debugMode = False
 haveBorders = False  # Set to True to draw thin black borders on the balls
+borderWidth = 1  # Thin border width
+borderColor = np.array((0, 0, 0), dtype=np.uint8)
+backgroundColor = (30, 30, 30)
+layeredRendering = True  # Cache balls that stopped moving in a static layer and only redraw the moving ones
+colorSampling = "point"  # "point", "box" or "radius": how the source image is sampled under each ball
+ballDataFile = "ball_data.bin"
+exportJson = False  # Also write ball_data.json next to the binary file
+replayBallData = None  # Path of a ball_data.bin from an earlier run: skip phase 1 and replay its colours
+parallelCollisions = True  # Set to False to resolve collisions on a single core
+stripWorkers = 0  # Processes that each simulate one vertical strip of the canvas, for 4K/8K; 0 simulates in this one
+headlessMode = False  # Set to True to render offline: no window, fixed timestep, one video frame per sim frame
+simProcess = False  # Run the live simulation in its own process, handing snapshots to the window through shared memory
+trajectoryCache = False  # Record phase 2 once per physics config; later images only re-render it
+trajectoryCacheDir = "trajectory_cache"
+checkpointFile = "checkpoint.bin"  # Phase-1 state saved every checkpointInterval frames
+checkpointInterval = 600  # Frames between checkpoints; 0 disables them
+settledCheckpointFile = "settled_checkpoint.bin"  # The settled phase-1 pile, saved just before colour mapping
+resumeCheckpoint = None  # Path of a checkpoint to continue from, e.g. settledCheckpointFile to redo only phase 2
+telemetryFile = None  # Path of a JSON-lines trace of per-frame stage timings; None turns instrumentation off
+telemetrySummary = True  # With telemetry on, also show mean stage times in the progress bar
 
 screenWidth, screenHeight = (1920//1, 1080//1)
 ballRadius = 4
 cellSize = ballRadius * 2
 gravity = 1000
 subSteps = 8
+adaptiveSubsteps = False  # Set to True to pick each frame's substep count from the fastest ball instead
+minSubSteps = 1  # Adaptive substep count for a pile at rest
+maxSubSteps = 8  # Adaptive substep count ceiling for violent frames
+stepMoveLimit = 1.0  # Adaptive mode keeps every ball's move per substep below this many ball radii
+stepSagLimit = 0.05  # Same for the gravity sag per substep down a stack of awake balls
+reorderInterval = 30  # Frames between sorting ball storage into grid-cell order
 baseDt = 1 / 60.0
+settleSeconds = 10  # Longest simulated time each phase is left to settle
+settleSpeed = 20.0  # RMS ball speed (px/s) below which the pile counts as at rest
+settleCalmFrames = 30  # Consecutive calm frames needed before moving on
+fullnessThreshold = 0.99
+sleepDistance = 1.0  # Balls that stay within this many px of one spot for sleepFrames frames stop being simulated
+sleepFrames = 0  # 0 keeps every ball awake; sleeping speeds up big piles but changes the result
+wakeDepth = 1.0  # Overlap in px with an awake ball that wakes a sleeping one
+stepCount = subSteps  # Substeps in the current frame; only changes in adaptive mode
 dt = baseDt / subSteps
-dt2 = dt * dt
+sleepAfter = sleepFrames * subSteps if sleepFrames > 0 else np.iinfo(np.int32).max
 numSpouts = 16
 fixedAngle = math.radians(45)
 fixedSpeed = 300.0
 spoutStartX = (screenWidth - (numSpouts * 2 * ballRadius)) // 2 + ballRadius
 spouts = [(spoutStartX + i * 2 * ballRadius, ballRadius) for i in range(numSpouts)]
+spoutArray = np.array(spouts, dtype=np.float32)
+launchDx = fixedSpeed * math.cos(fixedAngle) * baseDt
+launchDy = fixedSpeed * math.sin(fixedAngle) * baseDt
+launchSpeed = math.hypot(launchDx, launchDy) / dt  # px/s; launchDx/launchDy are moves per subSteps substep
 spawnDelay = 0.001
 ballArea = math.pi * (ballRadius ** 2)
 screenArea = screenWidth * screenHeight
-maxBalls = 3000000
-simPositions = np.empty((maxBalls, 2), dtype=np.float32)
-simPrev = np.empty((maxBalls, 2), dtype=np.float32)
-radii = np.full(maxBalls, ballRadius, dtype=np.float32)
-colors = []
-renderPositionsOld = np.zeros((maxBalls, 2), dtype=np.float32)
-renderPositionsCurrent = np.zeros((maxBalls, 2), dtype=np.float32)
+expectedBalls = int(fullnessThreshold * screenArea / ballArea) + numSpouts  # Phase 1 stops filling here
+balls = ParticleStore(expectedBalls, ballRadius)  # Grows when a replay needs more room
 cellsX = int(screenWidth // cellSize) + 1
 cellsY = int(screenHeight // cellSize) + 1
-lastSimTime = time.time()
-simLock = threading.Lock()
+gridCellIds, gridCellStart, gridSorted, gridCellState = allocate_grid(balls.capacity, cellsX, cellsY)
+simLock = TimedLock() if telemetryFile else threading.Lock()
+snapshots = SnapshotRing(balls.capacity, simLock)
 nBalls = 0
 originalBallCount = 0
 mode = 0
 coloringTriggered = False
-mode1Colors = [None] * maxBalls
+mode1Colors = np.full((balls.capacity, 3), 255, dtype=np.uint8)  # Per spawn index; white until phase 1 is mapped
 mode1SpawnIndex = 0
-frameQueue = queue.Queue(maxsize=1000)
+frameBuffers = 8  # Frames buffered between the renderer and the encoder
+videoPipeline = None
 recordingActive = False
-recordStop = False
+frameBuffer = np.zeros((screenHeight, screenWidth, 3), dtype=np.uint8)  # Shared by the display and the video encoder
+renderer = None  # The LayeredRenderer drawing frameBuffer when layeredRendering is on
+simRunning = True
+simCompleted = False
+trajectoryWriter = None
+spawnTimer = 0.0
+phaseFrame = 0
+settleFrames = 0
+calmFrames = 0
+pbar = None
+telemetry = None
+lastFrameStart = None
+stripSim = None
+simWorker = None  # The simulation process when simProcess is on
 
-def recordVideoThread():
-    global recordStop
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter('output.mp4', fourcc, 60, (screenWidth, screenHeight))
-    while not recordStop or not frameQueue.empty():
-        try:
-            frame = frameQueue.get(timeout=0.1)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-            out.write(frame)
-        except queue.Empty:
-            continue
-    out.release()
-    print("Recording thread finished and video file is finalized.")
+def advanceFrame():
+    """
+    Run one fixed-timestep frame of the simulation: phase bookkeeping,
+    spawning and physics. Sets simRunning to False once phase 2 has settled.
+    """
+    global nBalls, mode, coloringTriggered, originalBallCount, mode1SpawnIndex, recordingActive
+    global simRunning, simCompleted, spawnTimer, phaseFrame, settleFrames, calmFrames, pbar, lastFrameStart
+    if telemetry is not None:
+        frameStart = time.perf_counter()
+    # The settled checkpoint holds the state from before this frame, so
+    # resuming from it runs the frame again and ends phase 1 the same way.
+    frameStartState = checkpointState() if mode == 0 and settledCheckpointFile else None
+    phaseFrame += 1
+    spawnTimer += baseDt
+    spawnCount = 0
+    firstId = 0
+    currentFullness = (nBalls * ballArea) / screenArea
+    if mode == 0:
+        if pbar is None:
+            pbar = progressBar(total=fullnessThreshold, desc="Phase 1: Filling", leave=True)
+        pbar.n = currentFullness
+        pbar.refresh()
+        if currentFullness < fullnessThreshold and spawnTimer >= spawnDelay:
+            spawnTimer -= spawnDelay
+            while spawnCount < numSpouts and ((nBalls + spawnCount) * ballArea) / screenArea < fullnessThreshold:
+                spawnCount += 1
+            firstId = nBalls
+        # Wait for settling once fullness threshold is reached
+        if currentFullness >= fullnessThreshold and not coloringTriggered:
+            settleFrames += 1
+            if pileSettled() or settleFrames * baseDt >= settleSeconds:
+                if frameStartState is not None:
+                    saveCheckpoint(settledCheckpointFile, frameStartState, settled=True)
+                coloringTriggered = True
+                originalBallCount = nBalls
+                sampled = sample_colors(loadSourceImage(), balls.pos[:nBalls, 0], balls.pos[:nBalls, 1],
+                                        colorSampling, radii=balls.radii[:nBalls])
+                mode1Colors[balls.ids[:nBalls]] = sampled
+                if trajectoryWriter is not None:
+                    trajectoryWriter.set_sample(balls.pos, balls.ids, nBalls)
+                balls.colors[:nBalls] = sampled
+                # Records go in spawn order; reordering has shuffled the slots
+                radii = np.empty(nBalls, dtype=np.float32)
+                radii[balls.ids[:nBalls]] = balls.radii[:nBalls]
+                write_ball_data(ballDataFile, np.arange(nBalls), radii, mode1Colors[:nBalls])
+                if exportJson:
+                    export_json(os.path.splitext(ballDataFile)[0] + ".json", load_ball_data(ballDataFile))
+                pbar.close()
+                pbar = None
+                print(f"Phase 1 reached {fullnessThreshold} fullness and settled after {settleFrames * baseDt:.1f} seconds. Color mapping complete. Starting phase 2 replay and video recording.")
+                nBalls = 0
+                mode = 1
+                mode1SpawnIndex = 0
+                phaseFrame = 0
+                settleFrames = 0
+                calmFrames = 0
+                recordingActive = True
+    elif mode == 1:
+        if pbar is None:
+            pbar = progressBar(total=originalBallCount * 0.99, desc="Phase 2: Replaying", leave=True)
+        if spawnTimer >= spawnDelay:
+            spawnTimer -= spawnDelay
+            spawnCount = max(0, min(numSpouts, originalBallCount - mode1SpawnIndex))
+            firstId = mode1SpawnIndex
+            mode1SpawnIndex += spawnCount
+        pbar.n = nBalls
+        pbar.refresh()
+        if nBalls >= 0.99 * originalBallCount:
+            settleFrames += 1
+            if pileSettled() or settleFrames * baseDt >= settleSeconds:
+                print(f"Phase 2 reached 0.99 of original ball count and settled after {settleFrames * baseDt:.1f} seconds. Stopping simulation and recording.")
+                simRunning = False
+                simCompleted = True
+    reserveBalls(nBalls + spawnCount, firstId + spawnCount)
+    # Periodically store balls in grid-cell order so neighbour reads hit
+    # contiguous memory. Everything indexed by slot has to follow along.
+    order = None
+    nKept = nBalls
+    if telemetry is not None:
+        reorderStart = time.perf_counter()
+    if phaseFrame % reorderInterval == 0 and nBalls > 0 and stripSim is None:
+        build_grid(balls.pos, nBalls, cellSize, cellsX, cellsY, gridCellIds, gridCellStart, gridSorted)
+        order = gridSorted[:nBalls].copy()
+        reorder_particles(order, nBalls, balls.arrays())
+    stepLaunchDx, stepLaunchDy = launchDx, launchDy
+    if adaptiveSubsteps:
+        steps = choose_substeps(balls.pos, balls.prev, balls.still, nBalls, sleepAfter, dt, baseDt,
+                                launchSpeed if spawnCount > 0 else 0.0, gravity, ballRadius,
+                                stepMoveLimit * ballRadius, stepSagLimit * ballRadius, minSubSteps, maxSubSteps)
+        if steps != stepCount:
+            setSubsteps(steps)
+        stepLaunchDx = launchDx * subSteps / stepCount
+        stepLaunchDy = launchDy * subSteps / stepCount
+    if stripSim is not None:
+        stepStart = time.perf_counter()
+        nBalls = stripStep(spawnCount, firstId, stepLaunchDx, stepLaunchDy)
+        if telemetry is not None:
+            # The stages run inside the strip workers; only the whole strip step is timed here
+            stats = {"spawn_ms": None, "integrate_ms": None, "collide_ms": None,
+                     "strips_ms": (time.perf_counter() - stepStart) * 1000}
+    elif telemetry is None:
+        nBalls = step_frame(balls.pos, balls.prev, balls.radii, balls.ids, balls.colors, balls.anchors, balls.still,
+                            nBalls, spoutArray, stepLaunchDx, stepLaunchDy, spawnCount, firstId, mode1Colors,
+                            stepCount, dt, screenWidth, screenHeight, gravity, False, sleepDistance ** 2, sleepAfter,
+                            wakeDepth, cellSize, cellsX, cellsY, gridCellIds, gridCellStart, gridSorted,
+                            gridCellState, parallelCollisions)
+    else:
+        stepStart = time.perf_counter()
+        nBalls, stats = stagedStep(spawnCount, firstId, stepLaunchDx, stepLaunchDy)
+        stats["strips_ms"] = None
+    if telemetry is not None:
+        stats["steps"] = stepCount
+        stats["reorder_ms"] = (stepStart - reorderStart) * 1000
+    if trajectoryWriter is not None and recordingActive:
+        trajectoryWriter.append(balls.pos, balls.ids, nBalls)
+    # Only phase 1 is checkpointed: resuming in phase 2 would lose the video recorded before the checkpoint.
+    if checkpointInterval > 0 and mode == 0 and phaseFrame % checkpointInterval == 0:
+        saveCheckpoint(checkpointFile, checkpointState())
+    if not headlessMode:
+        publishStart = time.perf_counter() if telemetry is not None else 0.0
+        snapshots.publish(balls.pos, balls.radii, balls.ids, balls.colors, nBalls, nKept, order, time.time())
+        if telemetry is not None:
+            stats["snapshot_ms"] = (time.perf_counter() - publishStart) * 1000
+            stats["lock_wait_ms"] = simLock.take_wait() * 1000
+    if telemetry is not None:
+        stats["step_ms"] = (time.perf_counter() - frameStart) * 1000
+        if lastFrameStart is not None:
+            stats["rate_hz"] = 1.0 / (frameStart - lastFrameStart)
+        lastFrameStart = frameStart
+        telemetry.record("sim", frame=phaseFrame, phase=mode, balls=nBalls, **stats)
+        if telemetrySummary and pbar is not None and phaseFrame % 30 == 0:
+            stages = ("strips_ms",) if stripSim is not None else ("integrate_ms", "collide_ms")
+            pbar.set_postfix_str(telemetry.summary("sim", stages + ("rate_hz",)), refresh=False)
+
+def progressBar(**kwargs):
+    """
+    A tqdm progress bar. tqdm guards its bars with a multiprocessing lock by
+    default, which would load multiprocessing in every mode; a thread lock
+    is enough, as bars are only drawn from one process at a time.
+    """
+    from tqdm import tqdm
+    tqdm.set_lock(threading.RLock())
+    return tqdm(ncols=100, **kwargs)
+
+def reserveBalls(slots, spawnIds):
+    """
+    Make sure the particle store holds at least slots balls and mode1Colors
+    covers spawnIds spawn indices, growing the grid scratch buffers with the store.
+    """
+    global mode1Colors, gridCellIds, gridCellStart, gridSorted, gridCellState
+    if balls.reserve(slots):
+        gridCellIds, gridCellStart, gridSorted, gridCellState = allocate_grid(balls.capacity, cellsX, cellsY)
+    mode1Colors = grow_rows(mode1Colors, spawnIds, 255)
+
+def setSubsteps(steps):
+    """
+    Run steps substeps per frame from now on, keeping every ball's velocity
+    and how long it has been quiet.
+    """
+    global stepCount, dt, sleepAfter
+    change_substeps(balls.pos, balls.prev, balls.still, nBalls, stepCount, steps)
+    stepCount = steps
+    dt = baseDt / steps
+    sleepAfter = sleepFrames * steps if sleepFrames > 0 else np.iinfo(np.int32).max
+
+def stripStep(spawnCount, firstId, stepLaunchDx, stepLaunchDy):
+    """
+    step_frame on the strip workers. The particle store mirrors their balls
+    in spawn-index slots, which is what the rest of the frame reads.
+    """
+    # Whatever changed the balls outside the strips, a phase change or a
+    # loaded checkpoint, also changed how many there are.
+    if nBalls != stripSim.count:
+        stripSim.scatter(balls, nBalls, stepCount)
+    n = stripSim.step(spawnCount, firstId, mode1Colors[firstId:firstId + spawnCount], stepLaunchDx, stepLaunchDy,
+                      stepCount, dt, sleepAfter)
+    stripSim.gather(balls)
+    return n
+
+def stagedStep(spawnCount, firstId, stepLaunchDx, stepLaunchDy):
+    """
+    step_frame split into its stages from Python so that each can be timed.
+    It runs the same kernels in the same order, so results are identical;
+    only used with telemetry on, as the extra calls cost a little.
+    """
+    collide = collision_detection_parallel if parallelCollisions else collision_detection
+    t0 = time.perf_counter()
+    n = spawn_balls(balls.pos, balls.prev, balls.ids, balls.colors, balls.anchors, balls.still, nBalls,
+                    spoutArray, stepLaunchDx, stepLaunchDy, spawnCount, firstId, mode1Colors)
+    t1 = time.perf_counter()
+    integrateTime = 0.0
+    collideTime = 0.0
+    for _ in range(stepCount):
+        a = time.perf_counter()
+        update_positions(balls.pos, balls.prev, balls.radii, balls.anchors, balls.still, n, dt, dt * dt,
+                         screenWidth, screenHeight, gravity, False, sleepDistance ** 2, sleepAfter)
+        b = time.perf_counter()
+        collide(balls.pos, balls.radii, balls.still, n, sleepAfter, wakeDepth, cellSize, cellsX, cellsY,
+                gridCellIds, gridCellStart, gridSorted, gridCellState)
+        c = time.perf_counter()
+        integrateTime += b - a
+        collideTime += c - b
+    return n, {"spawn_ms": (t1 - t0) * 1000, "integrate_ms": integrateTime * 1000, "collide_ms": collideTime * 1000}
+
+def loadSourceImage():
+    image = pygame.image.load("source_image.png")
+    if pygame.display.get_surface() is not None:
+        image = image.convert()
+    image = pygame.transform.scale(image, (screenWidth, screenHeight))
+    return surface_to_array(image)
+
+def physicsConfig():
+    """
+    Everything the phase-2 trajectory depends on. The source image is not part
+    of it: it only decides the colours.
+    """
+    return {
+        "screen": [screenWidth, screenHeight], "ballRadius": ballRadius, "gravity": gravity,
+        "subSteps": subSteps, "baseDt": baseDt, "reorderInterval": reorderInterval,
+        "adaptiveSubsteps": adaptiveSubsteps, "minSubSteps": minSubSteps, "maxSubSteps": maxSubSteps,
+        "stepMoveLimit": stepMoveLimit, "stepSagLimit": stepSagLimit,
+        "parallelCollisions": parallelCollisions, "stripWorkers": stripWorkers, "spouts": spouts,
+        "launch": [launchDx, launchDy],
+        "spawnDelay": spawnDelay, "fullnessThreshold": fullnessThreshold, "settleSeconds": settleSeconds,
+        "settleSpeed": settleSpeed, "settleCalmFrames": settleCalmFrames, "sleepDistance": sleepDistance,
+        "sleepFrames": sleepFrames, "wakeDepth": wakeDepth,
+    }
+
+def trajectoryConfig():
+    """
+    What the cached trajectory and the colours of a re-render depend on:
+    physicsConfig, plus the pile phase 2 rebuilds when it does not come
+    from phase 1 under these settings. A replay takes its ball count and
+    colours from the ball data file; a settled checkpoint may hold a pile
+    from other settings.
+    """
+    config = physicsConfig()
+    config["replayBallData"] = replayBallData
+    if replayBallData is not None:
+        config["replayBalls"] = len(load_ball_data(replayBallData))
+    elif resumeCheckpoint is not None:
+        header, records, _ = load_checkpoint(resumeCheckpoint)
+        if header["settled"]:
+            config["settledPile"] = hashlib.sha1(np.ascontiguousarray(records).tobytes()).hexdigest()[:16]
+    return config
+
+def loadReplay(path):
+    """
+    Start directly in phase 2 with the colours of an earlier run. The spawn
+    schedule is deterministic, so the replay lands the balls where that run did.
+    """
+    global mode, coloringTriggered, originalBallCount, recordingActive
+    records = load_ball_data(path)
+    originalBallCount = len(records)
+    reserveBalls(originalBallCount, originalBallCount)
+    mode1Colors[records["ballNumber"]] = records["color"][:, :3]
+    coloringTriggered = True
+    recordingActive = True
+    mode = 1
+
+def checkpointState():
+    """
+    The scalar engine state between two frames, as stored in a checkpoint.
+    """
+    return {
+        "mode": mode, "coloring": coloringTriggered, "recording": recordingActive, "phase_frame": phaseFrame,
+        "spawn_index": mode1SpawnIndex, "original_count": originalBallCount, "settle_frames": settleFrames,
+        "calm_frames": calmFrames, "spawn_timer": spawnTimer, "sub_steps": stepCount,
+    }
+
+def saveCheckpoint(path, state, settled=False):
+    """
+    Write the particle store, the phase-2 palette and state to path. The
+    balls must not have moved since state was taken.
+    """
+    write_checkpoint(path, balls, nBalls, mode1Colors, originalBallCount if coloringTriggered else 0,
+                     width=screenWidth, height=screenHeight, config=config_key(physicsConfig()), settled=settled,
+                     **state)
+
+def loadCheckpoint(path):
+    """
+    Continue from a checkpoint. Apart from a settled one, which only needs
+    the same screen, it must come from a run with the same physics config.
+    """
+    global nBalls, mode, coloringTriggered, recordingActive, phaseFrame, mode1SpawnIndex, originalBallCount
+    global settleFrames, calmFrames, spawnTimer, stepCount, dt, sleepAfter
+    header, records, palette = load_checkpoint(path)
+    if (header["width"], header["height"]) != (screenWidth, screenHeight):
+        raise ValueError(f"{path} was saved at {header['width']}x{header['height']}, not {screenWidth}x{screenHeight}")
+    if not header["settled"] and header["config"].decode() != config_key(physicsConfig()):
+        raise ValueError(f"{path} was saved with different physics settings")
+    nBalls = len(records)
+    reserveBalls(nBalls, max(nBalls, len(palette)))
+    balls.pos[:nBalls] = records["pos"]
+    balls.prev[:nBalls] = records["prev"]
+    balls.anchors[:nBalls] = records["anchor"]
+    balls.radii[:nBalls] = records["radius"]
+    balls.ids[:nBalls] = records["id"]
+    balls.still[:nBalls] = records["still"]
+    balls.colors[:nBalls] = records["color"][:, :3]
+    mode1Colors[:len(palette)] = palette
+    mode = int(header["mode"])
+    coloringTriggered = bool(header["coloring"])
+    recordingActive = bool(header["recording"])
+    phaseFrame = int(header["phase_frame"])
+    mode1SpawnIndex = int(header["spawn_index"])
+    originalBallCount = int(header["original_count"])
+    settleFrames = int(header["settle_frames"])
+    calmFrames = int(header["calm_frames"])
+    spawnTimer = float(header["spawn_timer"])
+    # Velocities are stored per substep of the frame the checkpoint was taken in
+    stepCount = int(header["sub_steps"])
+    dt = baseDt / stepCount
+    sleepAfter = sleepFrames * stepCount if sleepFrames > 0 else np.iinfo(np.int32).max
+    if not adaptiveSubsteps and stepCount != subSteps:
+        setSubsteps(subSteps)
+    print(f"Resuming from {'settled ' if header['settled'] else ''}checkpoint {path} with {nBalls} balls.")
+
+def pileSettled():
+    """
+    Count consecutive frames whose RMS ball speed is below settleSpeed and
+    report whether there have been settleCalmFrames of them.
+    """
+    global calmFrames
+    total, _ = motion_stats(balls.pos, balls.prev, nBalls)
+    rmsSpeed = math.sqrt(total / nBalls) / dt if nBalls > 0 else 0.0
+    calmFrames = calmFrames + 1 if rmsSpeed < settleSpeed else 0
+    return calmFrames >= settleCalmFrames
+
+def stopSimulation():
+    global simRunning
+    simRunning = False
+    if simWorker is not None:
+        snapshots.state[5] = 1  # Checked by simulationProcess between frames
+
+def shareSimState():
+    """
+    Pass the scalars the window shows or acts on to the render process.
+    """
+    snapshots.state[:5] = (mode, recordingActive, nBalls, originalBallCount, simRunning)
+
+def takeSimState():
+    """
+    Counterpart of shareSimState in the render process. The simulation also
+    counts as stopped once its process has exited.
+    """
+    global mode, recordingActive, nBalls, originalBallCount, simRunning
+    state = [int(value) for value in snapshots.state[:5]]
+    mode, nBalls, originalBallCount = state[0], state[2], state[3]
+    recordingActive = bool(state[1])
+    simRunning = bool(state[4]) and simWorker.is_alive()
+
+def simulationProcess(cacheKey):
+    """
+    Body of the simulation process: setupSimulation, then simulationLoop's
+    paced frames until the pile settles or the window asks it to stop.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the window process
+    setupSimulation(cacheKey)
+    shareSimState()
+    while simRunning and not snapshots.state[5]:
+        simStart = time.time()
+        advanceFrame()
+        shareSimState()
+        sleepTime = baseDt - (time.time() - simStart)
+        if sleepTime > 0:
+            time.sleep(sleepTime)
+    finishTrajectory()
+    if telemetry is not None:
+        telemetry.close()
 
 def simulationLoop():
-    global nBalls, mode, coloringTriggered, originalBallCount, recordStop, mode1SpawnIndex, recordingActive
-    spawnTimer = 0.0
-    fullnessThreshold = 0.99
-    phase1_chill_start = None   # Settle timer for phase 1
-    phase2_chill_start = None
-    running = True
-    pbar = None
-    while running:
+    while simRunning:
         try:
             simStart = time.time()
-            spawnTimer += baseDt
-            currentFullness = (nBalls * ballArea) / screenArea
-            if mode == 0:
-                if pbar is None:
-                    pbar = tqdm(total=fullnessThreshold, desc="Phase 1: Filling", ncols=100, leave=True)
-                pbar.n = currentFullness
-                pbar.refresh()
-                if currentFullness < fullnessThreshold and spawnTimer >= spawnDelay:
-                    spawnTimer -= spawnDelay
-                    for spout in spouts:
-                        if nBalls < maxBalls and (nBalls * ballArea) / screenArea < fullnessThreshold:
-                            x, y = spout
-                            vx = fixedSpeed * math.cos(fixedAngle)
-                            vy = fixedSpeed * math.sin(fixedAngle)
-                            simPositions[nBalls] = (x, y)
-                            simPrev[nBalls] = (x - vx * baseDt, y - vy * baseDt)
-                            colors.append((255, 255, 255))
-                            nBalls += 1
-                # Wait 10 seconds for settling once fullness threshold is reached
-                if currentFullness >= fullnessThreshold and not coloringTriggered:
-                    if phase1_chill_start is None:
-                        phase1_chill_start = time.time()
-                    elif time.time() - phase1_chill_start >= 10:  # 10-second settle period
-                        coloringTriggered = True
-                        originalBallCount = nBalls
-                        image = pygame.image.load("source_image.png").convert()
-                        image = pygame.transform.scale(image, (screenWidth, screenHeight))
-                        for i in range(nBalls):
-                            x = int(np.clip(simPositions[i, 0], 0, screenWidth - 1))
-                            y = int(np.clip(simPositions[i, 1], 0, screenHeight - 1))
-                            c = image.get_at((x, y))
-                            mode1Colors[i] = (c.r, c.g, c.b)
-                            colors[i] = (c.r, c.g, c.b)
-                        ballData = [{"color": c} for c in mode1Colors[:nBalls]]
-                        with open("ball_data.json", "w") as f:
-                            json.dump({"ball_count": nBalls, "balls": ballData}, f, indent=4)
-                        nBalls = 0
-                        colors.clear()
-                        mode = 1
-                        mode1SpawnIndex = 0
-                        recordingActive = True
-                        pbar.close()
-                        pbar = None
-                        print("Phase 1 reached 0.99 fullness and settled for 10 seconds. Color mapping complete. Starting phase 2 replay and video recording.")
-            elif mode == 1:
-                if pbar is None:
-                    pbar = tqdm(total=originalBallCount * 0.99, desc="Phase 2: Replaying", ncols=100, leave=True)
-                if spawnTimer >= spawnDelay:
-                    spawnTimer -= spawnDelay
-                    for i in range(numSpouts):
-                        if mode1SpawnIndex < originalBallCount and nBalls < maxBalls:
-                            x, y = spouts[i]
-                            vx = fixedSpeed * math.cos(fixedAngle)
-                            vy = fixedSpeed * math.sin(fixedAngle)
-                            simPositions[nBalls] = (x, y)
-                            simPrev[nBalls] = (x - vx * baseDt, y - vy * baseDt)
-                            colors.append(mode1Colors[mode1SpawnIndex])
-                            nBalls += 1
-                            mode1SpawnIndex += 1
-                pbar.n = nBalls
-                pbar.refresh()
-                if nBalls >= 0.99 * originalBallCount:
-                    if phase2_chill_start is None:
-                        phase2_chill_start = time.time()
-                    elif time.time() - phase2_chill_start >= 10:  # 10-second settle period in phase 2
-                        print("Phase 2 reached 0.99 of original ball count and settled for 10 seconds. Stopping simulation and recording.")
-                        recordStop = True
-                        running = False
-                        pygame.event.post(pygame.event.Event(pygame.QUIT))
-            for _ in range(subSteps):
-                update_positions(simPositions, simPrev, radii, nBalls, dt, dt2, screenWidth, screenHeight, gravity, 0)
-                collision_detection(simPositions, radii, nBalls, cellSize, cellsX, cellsY)
-            with simLock:
-                renderPositionsOld[:nBalls] = renderPositionsCurrent[:nBalls]
-                renderPositionsCurrent[:nBalls] = simPositions[:nBalls]
-                lastSimTime = time.time()
+            advanceFrame()
+            if not simRunning:
+                pygame.event.post(pygame.event.Event(pygame.QUIT))
             simElapsed = time.time() - simStart
             sleepTime = baseDt - simElapsed
             if sleepTime > 0:
                 time.sleep(sleepTime)
         except KeyboardInterrupt:
-            running = False
+            stopSimulation()
 
-pygame.init()
-screen = pygame.display.set_mode((screenWidth, screenHeight))
-pygame.display.set_caption("Adjacent Spouts Fluid Display")
-clock = pygame.time.Clock()
-font = pygame.font.SysFont("Arial", 24)
+def drawBalls(positions, radii, nb, ballColors, ids=None):
+    """
+    Draw the first nb balls into frameBuffer, which frameSurface shows. With
+    ids, the spawn index of the ball in each slot, they are stacked in spawn
+    order, so overlaps do not flip when the storage is reordered.
+    """
+    if renderer is not None:
+        renderer.draw(frameBuffer, positions, radii, ballColors, nb, ids)
+    else:
+        if ids is not None:
+            slots = np.empty(nb, dtype=np.intp)
+            slots[ids[:nb]] = np.arange(nb)
+            positions, radii, ballColors = positions[slots], radii[slots], ballColors[slots]
+        frameBuffer[:] = backgroundColor
+        # Balls still sitting in a spout are skipped (2-pixel tolerance)
+        draw_circles(frameBuffer, positions, radii, ballColors, nb,
+                     borderWidth if haveBorders else 0, borderColor, spoutArray)
 
 def drawStatus():
+    """
+    Draw the status text into frameBuffer, so that recorded frames carry it
+    as they did when the video was grabbed from the window.
+    """
     if mode == 0:
         fullness = (nBalls * ballArea) / screenArea * 100
     else:
         fullness = (nBalls / originalBallCount) * 100 if originalBallCount > 0 else 0
     status = [
         f"Mode: {'Filling' if mode == 0 else 'Replaying'}",
-        f"Balls: {nBalls}/{maxBalls}",
+        f"Balls: {nBalls}/{balls.capacity}",
         f"Fullness: {fullness:.2f}%",
         f"FPS: {clock.get_fps():.1f}"
     ]
     yOffset = 10
     for text in status:
         surface = font.render(text, True, (255, 255, 0), (0, 0, 0))
-        screen.blit(surface, (10, yOffset))
+        rect = frameSurface.blit(surface, (10, yOffset))
+        if renderer is not None:
+            renderer.invalidate(rect.left, rect.top, rect.right, rect.bottom)
         yOffset += 30
 
-recordThread = threading.Thread(target=recordVideoThread)
-recordThread.start()
-simThread = threading.Thread(target=simulationLoop)
-simThread.start()
-running = True
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-    screen.fill((30, 30, 30))
-    with simLock:
-        nb = nBalls
-        rOld = renderPositionsOld.copy()
-        rCurrent = renderPositionsCurrent.copy()
-        lastUpdate = lastSimTime
-        colorsCopy = colors.copy()
-    alpha = min((time.time() - lastUpdate) / baseDt, 1.0)
-    interp = rOld[:nb] * (1 - alpha) + rCurrent[:nb] * alpha
-    for i in range(nb):
-        x, y = map(int, interp[i])
-        # Skip drawing if the ball is still at a spout (using a 2-pixel tolerance)
-        if abs(y - ballRadius) < 2 and any(abs(x - sp[0]) < 2 for sp in spouts):
-            continue
-        col = colorsCopy[i] if i < len(colorsCopy) else (255, 255, 255)
-        if haveBorders:
-            border_width = 1  # Thin border width
-            pygame.draw.circle(screen, (0, 0, 0), (x, y), ballRadius)
-            pygame.draw.circle(screen, col, (x, y), ballRadius - border_width)
+def runInteractive():
+    if simWorker is None:
+        simThread = threading.Thread(target=simulationLoop)
+        simThread.start()
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+        if simWorker is not None:
+            takeSimState()
+            running = running and simRunning
+        if telemetry is not None:
+            t0 = time.perf_counter()
+        snapshot = snapshots.acquire()
+        if telemetry is not None:
+            t1 = t2 = time.perf_counter()
+        if snapshot is not None:
+            nb, rOld, rCurrent, ballRadii, ballIds, ballColors, lastUpdate = snapshot
+            alpha = min((time.time() - lastUpdate) / baseDt, 1.0)
+            interp = rOld[:nb] * (1 - alpha) + rCurrent[:nb] * alpha
+            # The slot can be published into again once released, and in the
+            # shared ring the check in release() only covers what was read before it
+            ballRadii = ballRadii[:nb].copy()
+            ballIds = ballIds[:nb].copy()
+            ballColors = ballColors[:nb].copy()
+            if not snapshots.release():
+                continue  # Overwritten while interpolating; the next one is already there
+            if telemetry is not None:
+                t2 = time.perf_counter()
+            drawBalls(interp, ballRadii, nb, ballColors, ballIds)
         else:
-            pygame.draw.circle(screen, col, (x, y), ballRadius)
-    drawStatus()
-    pygame.display.flip()
-    clock.tick(60)
-    if recordingActive:
-        frame = pygame.surfarray.array3d(pygame.display.get_surface())
-        frame = np.transpose(frame, (1, 0, 2))
-        try:
-            frameQueue.put_nowait(frame)
-        except queue.Full:
-            pass
-simThread.join()
-recordThread.join()
-pygame.quit()
-with open("output.mp4", "rb") as f:
-    mp4Data = f.read()
-mp4Hash = hashlib.md5(mp4Data).hexdigest()[:6]
-with open("phase2_hash.txt", "w") as f:
-    f.write(mp4Hash)
-print("Final MP4 hash (first 6 hex digits):", mp4Hash)
-folder_index = 1
-while os.path.exists(str(folder_index)):
-    folder_index += 1
-folder_name = str(folder_index)
-os.makedirs(folder_name)
-new_video_name = os.path.join(folder_name, f"{mp4Hash}.mp4")
-os.rename("output.mp4", new_video_name)
-shutil.copy("source_image.png", folder_name)
-print(f"Results saved in folder '{folder_name}' with video named '{mp4Hash}.mp4'.")
+            drawBalls(balls.pos, balls.radii, 0, balls.colors)
+        if telemetry is not None:
+            t3 = time.perf_counter()
+        drawStatus()
+        screen.blit(frameSurface, (0, 0))
+        pygame.display.flip()
+        if telemetry is not None:
+            t4 = time.perf_counter()
+        clock.tick(60)
+        if telemetry is not None:
+            t5 = time.perf_counter()
+        if recordingActive:
+            videoPipeline.submit(frameBuffer)
+        if telemetry is not None:
+            telemetry.record("render", snapshot_ms=(t1 - t0) * 1000, interpolate_ms=(t2 - t1) * 1000,
+                             rasterise_ms=(t3 - t2) * 1000, present_ms=(t4 - t3) * 1000,
+                             encode_ms=(time.perf_counter() - t5) * 1000, lock_wait_ms=simLock.take_wait() * 1000,
+                             dropped=videoPipeline.dropped, fps=clock.get_fps())
+    stopSimulation()
+    if simWorker is None:
+        simThread.join()
+    else:
+        simWorker.join()
+
+def renderTrajectory(cache):
+    """
+    Re-render a cached phase-2 trajectory with the current source image: one
+    gather at the positions phase 1 sampled at gives every ball its colour,
+    no simulation runs. A replay takes the colours of its ball data file.
+    """
+    if replayBallData is not None:
+        records = load_ball_data(replayBallData)
+        reserveBalls(len(records), len(records))
+        mode1Colors[records["ballNumber"]] = records["color"][:, :3]
+    else:
+        sample = cache.sample
+        n = len(sample)
+        reserveBalls(n, n)
+        mode1Colors[:n] = sample_colors(loadSourceImage(), sample[:, 0], sample[:, 1], colorSampling,
+                                        radii=balls.radii[:n])
+    for k in progressBar(iterable=range(len(cache)), desc="Rendering cached trajectory"):
+        if not headlessMode:
+            if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                break
+        positions = cache.frame(k)
+        drawBalls(positions, balls.radii, len(positions), mode1Colors)
+        if not headlessMode:
+            screen.blit(frameSurface, (0, 0))
+            pygame.display.flip()
+        videoPipeline.submit(frameBuffer)
+
+def runHeadless():
+    # Fixed timestep with no sleeping and no interpolation: every simulated
+    # frame in phase 2 becomes exactly one video frame, so a given config
+    # always produces the same output.
+    try:
+        while simRunning:
+            advanceFrame()
+            if recordingActive:
+                if telemetry is not None:
+                    t0 = time.perf_counter()
+                drawBalls(balls.pos, balls.radii, nBalls, balls.colors, balls.ids)
+                if telemetry is not None:
+                    t1 = time.perf_counter()
+                videoPipeline.submit(frameBuffer)
+                if telemetry is not None:
+                    telemetry.record("render", rasterise_ms=(t1 - t0) * 1000,
+                                     encode_ms=(time.perf_counter() - t1) * 1000)
+    except KeyboardInterrupt:
+        stopSimulation()
+
+def runCapacity():
+    """
+    Balls the run may hold, known before the checkpoint or replay it starts
+    from is loaded.
+    """
+    n = balls.capacity
+    if resumeCheckpoint is not None:
+        _, records, palette = load_checkpoint(resumeCheckpoint)
+        n = max(n, len(records), len(palette))
+    elif replayBallData is not None:
+        n = max(n, len(load_ball_data(replayBallData)))
+    return n
+
+def warmupKernels():
+    """
+    Compile every kernel a frame calls, or load it from numba's on-disk cache,
+    by calling it on zero balls with the same argument types as the frame
+    does. Otherwise the first frames of phase 1 stall while they compile.
+    """
+    motion_stats(balls.pos, balls.prev, 0)
+    if adaptiveSubsteps:
+        choose_substeps(balls.pos, balls.prev, balls.still, 0, sleepAfter, dt, baseDt, 0.0, gravity, ballRadius,
+                        stepMoveLimit * ballRadius, stepSagLimit * ballRadius, minSubSteps, maxSubSteps)
+        change_substeps(balls.pos, balls.prev, balls.still, 0, stepCount, stepCount)
+    if stripSim is not None:
+        return  # The strip workers warm up their own kernels
+    build_grid(balls.pos, 0, cellSize, cellsX, cellsY, gridCellIds, gridCellStart, gridSorted)
+    if telemetry is None:
+        step_frame(balls.pos, balls.prev, balls.radii, balls.ids, balls.colors, balls.anchors, balls.still, 0,
+                   spoutArray, launchDx, launchDy, 0, 0, mode1Colors, stepCount, dt, screenWidth, screenHeight,
+                   gravity, False, sleepDistance ** 2, sleepAfter, wakeDepth, cellSize, cellsX, cellsY, gridCellIds,
+                   gridCellStart, gridSorted, gridCellState, parallelCollisions)
+    else:
+        collide = collision_detection_parallel if parallelCollisions else collision_detection
+        spawn_balls(balls.pos, balls.prev, balls.ids, balls.colors, balls.anchors, balls.still, 0, spoutArray,
+                    launchDx, launchDy, 0, 0, mode1Colors)
+        update_positions(balls.pos, balls.prev, balls.radii, balls.anchors, balls.still, 0, dt, dt * dt,
+                         screenWidth, screenHeight, gravity, False, sleepDistance ** 2, sleepAfter)
+        collide(balls.pos, balls.radii, balls.still, 0, sleepAfter, wakeDepth, cellSize, cellsX, cellsY,
+                gridCellIds, gridCellStart, gridSorted, gridCellState)
+
+def setupSimulation(cacheKey):
+    """
+    Everything the simulation needs before its first frame, in the process
+    that will run it.
+    """
+    global trajectoryWriter
+    warmupKernels()
+    if cacheKey is not None:
+        trajectoryWriter = TrajectoryWriter(trajectoryCacheDir, cacheKey, screenWidth, screenHeight,
+                                            trajectoryConfig())
+    if resumeCheckpoint is not None:
+        loadCheckpoint(resumeCheckpoint)
+    elif replayBallData is not None:
+        loadReplay(replayBallData)
+
+def finishTrajectory():
+    if trajectoryWriter is not None:
+        if simCompleted:
+            trajectoryWriter.close()
+        else:
+            trajectoryWriter.abort()
+
+def main():
+    global screen, clock, font, frameSurface, videoPipeline, telemetry, stripSim, snapshots, simWorker, renderer
+    if stripWorkers > 0:
+        from strips import StripSimulation
+        # Started first, so that the forked workers inherit neither pygame nor numba threads.
+        stripSim = StripSimulation(stripWorkers, screenWidth, screenHeight, cellSize, ballRadius, spoutArray, gravity,
+                                   sleepDistance ** 2, wakeDepth)
+    if telemetryFile:
+        telemetry = Telemetry(telemetryFile)
+    cache = None
+    cacheKey = None
+    if trajectoryCache:
+        key = config_key(trajectoryConfig())
+        cache = TrajectoryReader.find(trajectoryCacheDir, key)
+        if cache is None:
+            cacheKey = key
+        else:
+            print(f"Using cached trajectory {key}: skipping simulation.")
+    forkSim = cache is None and simProcess and not headlessMode
+    if forkSim:
+        import multiprocessing
+        # As in strips.py: spawn would re-run main.py instead of inheriting the settings of this one.
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("simProcess needs the fork start method, which this platform lacks; simulating in this process.")
+            forkSim = False
+    if forkSim:
+        # Forked before pygame and before any parallel kernel has run here,
+        # so the simulation process inherits neither; it loads its own state.
+        snapshots = SharedSnapshotRing(runCapacity())
+        shareSimState()  # Running, while the process warms up its kernels and loads its state
+        simWorker = multiprocessing.get_context("fork").Process(target=simulationProcess, args=(cacheKey,))
+        simWorker.start()
+    elif cache is None:
+        setupSimulation(cacheKey)
+    if headlessMode:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pygame.init()
+    screen = pygame.display.set_mode((screenWidth, screenHeight))
+    pygame.display.set_caption("Adjacent Spouts Fluid Display")
+    clock = pygame.time.Clock()
+    font = pygame.font.SysFont("Arial", 24)
+    frameSurface = pygame.image.frombuffer(frameBuffer, (screenWidth, screenHeight), "RGB")
+    if layeredRendering:
+        renderer = LayeredRenderer(screenWidth, screenHeight, backgroundColor, borderWidth if haveBorders else 0,
+                                   borderColor, spoutArray)
+    # Offline rendering never drops frames; the live window keeps its frame
+    # rate and counts the frames the encoder could not keep up with.
+    videoPipeline = FramePipeline("output.mp4", screenWidth, screenHeight, fps=60, buffers=frameBuffers,
+                                  drop_when_full=not headlessMode and cache is None)
+    drawBalls(balls.pos, balls.radii, 0, balls.colors, balls.ids)  # Compiles the rasterizer before the first frame is due
+    if cache is not None:
+        renderTrajectory(cache)
+    elif headlessMode:
+        runHeadless()
+    else:
+        runInteractive()
+    videoPipeline.close()
+    if simWorker is not None:
+        snapshots.close()
+    if stripSim is not None:
+        stripSim.close()
+    if telemetry is not None:
+        telemetry.close()
+    print(f"Recording finished and video file is finalized ({videoPipeline.written} frames, {videoPipeline.dropped} dropped).")
+    if simWorker is None:
+        finishTrajectory()
+    pygame.quit()
+    with open("output.mp4", "rb") as f:
+        mp4Data = f.read()
+    mp4Hash = hashlib.md5(mp4Data).hexdigest()[:6]
+    with open("phase2_hash.txt", "w") as f:
+        f.write(mp4Hash)
+    print("Final MP4 hash (first 6 hex digits):", mp4Hash)
+    folder_index = 1
+    while os.path.exists(str(folder_index)):
+        folder_index += 1
+    folder_name = str(folder_index)
+    os.makedirs(folder_name)
+    new_video_name = os.path.join(folder_name, f"{mp4Hash}.mp4")
+    os.rename("output.mp4", new_video_name)
+    shutil.copy("source_image.png", folder_name)
+    print(f"Results saved in folder '{folder_name}' with video named '{mp4Hash}.mp4'.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import numpy as np
+
+def grow_rows(arr, n, fill=0):
+    """
+    Return arr with room for at least n rows, doubling its length when it has
+    to grow. Existing rows are kept and new ones are set to fill.
+    """
+    if n <= len(arr):
+        return arr
+    grown = np.empty((max(n, 2 * len(arr)),) + arr.shape[1:], dtype=arr.dtype)
+    grown[:len(arr)] = arr
+    grown[len(arr):] = fill
+    return grown
+
+class ParticleStore:
+    """
+    Per-slot ball state as a structure of arrays, sized for the balls the run
+    is expected to hold rather than a fixed maximum. reserve() doubles the
+    capacity when more are needed, so the arrays must be looked up on the
+    store again after it, not kept from before.
+    """
+
+    def __init__(self, capacity, radius):
+        capacity = max(capacity, 1)
+        self.pos = np.empty((capacity, 2), dtype=np.float32)
+        self.prev = np.empty((capacity, 2), dtype=np.float32)
+        self.radii = np.full(capacity, radius, dtype=np.float32)
+        self.ids = np.zeros(capacity, dtype=np.int32)  # Spawn index of the ball stored in each slot
+        self.colors = np.full((capacity, 3), 255, dtype=np.uint8)
+        self.anchors = np.empty((capacity, 2), dtype=np.float32)  # Where each ball's current quiet spell began
+        self.still = np.zeros(capacity, dtype=np.int32)  # Consecutive quiet substeps, asleep at sleepAfter
+        self.radius = radius
+
+    @property
+    def capacity(self):
+        return len(self.pos)
+
+    def arrays(self):
+        """
+        Every per-slot array, for operations that move balls between slots.
+        """
+        return self.pos, self.prev, self.radii, self.ids, self.colors, self.anchors, self.still
+
+    def reserve(self, n):
+        """
+        Make room for at least n balls. Returns True if the arrays were reallocated.
+        """
+        if n <= self.capacity:
+            return False
+        self.pos = grow_rows(self.pos, n)
+        self.prev = grow_rows(self.prev, n)
+        self.radii = grow_rows(self.radii, n, self.radius)
+        self.ids = grow_rows(self.ids, n)
+        self.colors = grow_rows(self.colors, n, 255)
+        self.anchors = grow_rows(self.anchors, n)
+        self.still = grow_rows(self.still, n)
+        return True
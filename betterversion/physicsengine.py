@@ -2,11 +2,19 @@ import math
 import numpy as np
 import numba
 
-@numba.njit(parallel=True)
-def update_positions(pos, prev, radii, n_balls, dt, dt2, width, height, gravity, settle):
+AWAKE = 1  # cell_state flags
+ASLEEP = 2
+
+@numba.njit(parallel=True, cache=True)
+def update_positions(pos, prev, radii, anchor, still, n_balls, dt, dt2, width, height, gravity, settle,
+                     sleep_dist2, sleep_after):
     """
     Update positions using Verlet integration.
     If settle is True, apply a damping factor and reduced effective gravity.
+    still[i] counts the substeps ball i has stayed within sqrt(sleep_dist2) of
+    anchor[i]; once it reaches sleep_after the ball is asleep and is no longer
+    integrated. Balls in a pile jitter every substep but go nowhere, so the
+    distance from an anchor is measured rather than the per-substep speed.
     """
     if settle:
         v_damp = 0.95
@@ -15,10 +23,24 @@ def update_positions(pos, prev, radii, n_balls, dt, dt2, width, height, gravity,
         v_damp = 1.0
         g_eff = gravity
     for i in numba.prange(n_balls):
+        if still[i] >= sleep_after:
+            continue
         x = pos[i, 0]
         y = pos[i, 1]
         prev_x = prev[i, 0]
         prev_y = prev[i, 1]
+        ax = x - anchor[i, 0]
+        ay = y - anchor[i, 1]
+        if ax * ax + ay * ay < sleep_dist2:
+            still[i] += 1
+            if still[i] >= sleep_after:
+                prev[i, 0] = x
+                prev[i, 1] = y
+                continue
+        else:
+            anchor[i, 0] = x
+            anchor[i, 1] = y
+            still[i] = 0
         new_x = x + (x - prev_x) * v_damp
         new_y = y + (y - prev_y) * v_damp + g_eff * dt2
         prev[i, 0] = x
@@ -39,15 +61,27 @@ def update_positions(pos, prev, radii, n_balls, dt, dt2, width, height, gravity,
             pos[i, 1] = height - r
             prev[i, 1] = pos[i, 1] + (pos[i, 1] - prev[i, 1]) * -0.8
 
-@numba.njit
-def collision_detection(pos, radii, n_balls, cell_size, cells_x, cells_y):
+def allocate_grid(max_balls, cells_x, cells_y):
     """
-    Grid–based collision detection and response.
+    Allocate the scratch buffers used by build_grid and collision detection
+    so they can be kept between substeps instead of being recreated on every call.
+    """
+    cell_ids = np.empty(max_balls, dtype=np.int32)
+    cell_start = np.zeros(cells_x * cells_y + 1, dtype=np.int32)
+    sorted_indices = np.empty(max_balls, dtype=np.int32)
+    cell_state = np.zeros(cells_x * cells_y, dtype=np.uint8)
+    return cell_ids, cell_start, sorted_indices, cell_state
+
+@numba.njit(parallel=True, cache=True)
+def build_grid(pos, n_balls, cell_size, cells_x, cells_y, cell_ids, cell_start, sorted_indices, origin_x=0.0):
+    """
+    Counting sort of balls into grid cells, in place and in linear time.
+    Balls of cell c end up in sorted_indices[cell_start[c]:cell_start[c + 1]].
+    Column 0 starts at x = origin_x.
     """
     total_cells = cells_x * cells_y
-    cell_ids = np.empty(n_balls, dtype=np.int32)
-    for i in range(n_balls):
-        cx = int(pos[i, 0] // cell_size)
+    for i in numba.prange(n_balls):
+        cx = int((pos[i, 0] - origin_x) // cell_size)
         cy = int(pos[i, 1] // cell_size)
         if cx < 0:
             cx = 0
@@ -59,82 +93,458 @@ def collision_detection(pos, radii, n_balls, cell_size, cells_x, cells_y):
             cy = cells_y - 1
         cell_ids[i] = cx + cy * cells_x
 
-    sorted_indices = np.argsort(cell_ids)
-    cell_start = -np.ones(total_cells, dtype=np.int32)
-    cell_end = -np.ones(total_cells, dtype=np.int32)
-
-    if n_balls > 0:
-        current_cell = cell_ids[sorted_indices[0]]
-        cell_start[current_cell] = 0
-        for k in range(n_balls):
-            cell_val = cell_ids[sorted_indices[k]]
-            if cell_val != current_cell:
-                cell_end[current_cell] = k
-                current_cell = cell_val
-                cell_start[current_cell] = k
-        cell_end[current_cell] = n_balls
+    cell_start[:] = 0
+    for i in range(n_balls):
+        cell_start[cell_ids[i]] += 1
+    # Inclusive prefix sum: cell_start[c] is where cell c ends...
+    total = 0
+    for c in range(total_cells):
+        total += cell_start[c]
+        cell_start[c] = total
+    # ...and filling backwards walks it down to where cell c starts.
+    for i in range(n_balls - 1, -1, -1):
+        c = cell_ids[i]
+        cell_start[c] -= 1
+        sorted_indices[cell_start[c]] = i
+    cell_start[total_cells] = n_balls
 
-    factor = 0.3
+@numba.njit(cache=True)
+def mark_awake_cells(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state):
+    """
+    For every grid cell, record whether resolve_cell will meet awake balls
+    (AWAKE), sleeping balls (ASLEEP) or both, looking at the cell itself and
+    the forward neighbours it is paired with.
+    """
+    cell_state[:] = 0
+    for i in range(n_balls):
+        flag = AWAKE if still[i] < sleep_after else ASLEEP
+        c = cell_ids[i]
+        cx = c % cells_x
+        cy = c // cells_x
+        cell_state[c] |= flag
+        if cy > 0:
+            cell_state[c - cells_x] |= flag
+        if cx > 0:
+            cell_state[c - 1] |= flag
+            if cy > 0:
+                cell_state[c - 1 - cells_x] |= flag
+            if cy < cells_y - 1:
+                cell_state[c - 1 + cells_x] |= flag
+
+@numba.njit(cache=True)
+def wake_near_moving(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state):
+    """
+    Wake every sleeping ball in or next to a cell holding a ball that left
+    its anchor or was woken this substep, so that sleepers whose support
+    moves away fall with it instead of hanging in the air. Uses cell_state
+    as scratch.
+    """
+    cell_state[:] = 0
+    sleepers = 0
+    for i in range(n_balls):
+        if still[i] == 0:
+            cell_state[cell_ids[i]] = AWAKE
+        elif still[i] >= sleep_after:
+            sleepers += 1
+    if sleepers == 0:
+        return
+    for i in range(n_balls):
+        if still[i] < sleep_after:
+            continue
+        c = cell_ids[i]
+        cx = c % cells_x
+        cy = c // cells_x
+        for ncy in range(max(cy - 1, 0), min(cy + 2, cells_y)):
+            for ncx in range(max(cx - 1, 0), min(cx + 2, cells_x)):
+                if cell_state[ncx + ncy * cells_x] != 0:
+                    still[i] = 0
+
+def reorder_particles(order, n_balls, arrays):
+    """
+    Permute the first n_balls rows of every array so that row k becomes
+    row order[k]. Called with the grid order to keep neighbours close in memory.
+    """
+    idx = order[:n_balls]
+    for arr in arrays:
+        arr[:n_balls] = arr[idx]
+
+@numba.njit(cache=True)
+def resolve_pair(pos, radii, i, j, share_i, share_j):
+    """
+    Push two overlapping balls apart along the line joining their centres,
+    each by its share of the overlap. Returns the overlap, or 0 if none.
+    """
+    dx = pos[j, 0] - pos[i, 0]
+    dy = pos[j, 1] - pos[i, 1]
+    dist = math.sqrt(dx * dx + dy * dy)
+    min_dist = radii[i] + radii[j]
+    if dist < min_dist:
+        if dist > 0.0:
+            overlap = min_dist - dist
+            nx = dx / dist
+            ny = dy / dist
+            shift_i = overlap * share_i
+            shift_j = overlap * share_j
+            pos[i, 0] -= nx * shift_i
+            pos[i, 1] -= ny * shift_i
+            pos[j, 0] += nx * shift_j
+            pos[j, 1] += ny * shift_j
+            return overlap
+        else:
+            pos[i, 0] -= min_dist * share_i
+            pos[j, 0] += min_dist * share_j
+            return min_dist
+    return 0.0
+
+@numba.njit(cache=True)
+def resolve_cell(pos, radii, sorted_indices, cell_start, cx, cy, cells_x, cells_y, factor):
+    """
+    Resolve collisions inside one cell and against its four forward neighbours.
+    Only touches balls in columns cx and cx + 1.
+    """
+    cell = cx + cy * cells_x
+    start_i = cell_start[cell]
+    end_i = cell_start[cell + 1]
+    if start_i == end_i:
+        return
     # Process collisions within the same cell.
-    for cell in range(total_cells):
-        if cell_start[cell] == -1:
+    for a in range(start_i, end_i):
+        i = sorted_indices[a]
+        for b in range(a + 1, end_i):
+            resolve_pair(pos, radii, i, sorted_indices[b], factor, factor)
+    # Process neighbor-cell collisions.
+    for off_x, off_y in ((1, -1), (1, 0), (1, 1), (0, 1)):
+        ncx = cx + off_x
+        ncy = cy + off_y
+        if ncx < 0 or ncx >= cells_x or ncy < 0 or ncy >= cells_y:
+            continue
+        neighbor_cell = ncx + ncy * cells_x
+        start_j = cell_start[neighbor_cell]
+        end_j = cell_start[neighbor_cell + 1]
+        for a in range(start_i, end_i):
+            i = sorted_indices[a]
+            for b in range(start_j, end_j):
+                resolve_pair(pos, radii, i, sorted_indices[b], factor, factor)
+
+@numba.njit(cache=True)
+def resolve_cell_sleeping(pos, radii, still, sleep_after, wake_depth, sorted_indices, cell_start,
+                          cx, cy, cells_x, cells_y, factor):
+    """
+    resolve_cell for cells where sleeping balls are involved. Pairs of
+    sleeping balls are skipped and a sleeping ball does not move, the awake
+    one only takes its own share, until an overlap deeper than wake_depth
+    wakes the sleeper for the next substep. Sleepers near balls on the move
+    are woken afterwards by wake_near_moving.
+    """
+    cell = cx + cy * cells_x
+    start_i = cell_start[cell]
+    end_i = cell_start[cell + 1]
+    if start_i == end_i:
+        return
+    # The cell itself first, then its forward neighbours.
+    for off_x, off_y in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        ncx = cx + off_x
+        ncy = cy + off_y
+        if ncx < 0 or ncx >= cells_x or ncy < 0 or ncy >= cells_y:
+            continue
+        neighbor_cell = ncx + ncy * cells_x
+        start_j = cell_start[neighbor_cell]
+        end_j = cell_start[neighbor_cell + 1]
+        for a in range(start_i, end_i):
+            i = sorted_indices[a]
+            asleep_i = still[i] >= sleep_after
+            for b in range(a + 1 if neighbor_cell == cell else start_j, end_j):
+                j = sorted_indices[b]
+                asleep_j = still[j] >= sleep_after
+                if asleep_i and asleep_j:
+                    continue
+                share_i = factor * (1 - asleep_i)
+                share_j = factor * (1 - asleep_j)
+                overlap = resolve_pair(pos, radii, i, j, share_i, share_j)
+                if overlap > wake_depth and (asleep_i or asleep_j):
+                    still[i] = 0
+                    still[j] = 0
+
+@numba.njit(cache=True)
+def collision_detection(pos, radii, still, n_balls, sleep_after, wake_depth, cell_size, cells_x, cells_y,
+                        cell_ids, cell_start, sorted_indices, cell_state):
+    """
+    Grid–based collision detection and response.
+    """
+    build_grid(pos, n_balls, cell_size, cells_x, cells_y, cell_ids, cell_start, sorted_indices)
+    mark_awake_cells(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state)
+    factor = 0.3
+    for cy in range(cells_y):
+        for cx in range(cells_x):
+            state = cell_state[cx + cy * cells_x]
+            if state == AWAKE:
+                resolve_cell(pos, radii, sorted_indices, cell_start, cx, cy, cells_x, cells_y, factor)
+            elif state != ASLEEP:
+                resolve_cell_sleeping(pos, radii, still, sleep_after, wake_depth, sorted_indices, cell_start,
+                                      cx, cy, cells_x, cells_y, factor)
+    wake_near_moving(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state)
+
+@numba.njit(cache=True)
+def push_from_ghosts(pos, radii, still, n_own, sleep_after, wake_depth, sorted_indices, cell_start,
+                     cx, cy, cells_x, cells_y, factor, push):
+    """
+    For a strip of a domain-decomposed run, where balls from n_own on are
+    ghosts: copies of balls owned by a neighbouring strip, which moves them
+    itself. Adds to push the share of every own ball in a pair with a ghost
+    instead of moving it, so that the neighbour, which resolves the same pair
+    from the same positions, moves its ball by exactly as much.
+    """
+    cell = cx + cy * cells_x
+    start_i = cell_start[cell]
+    end_i = cell_start[cell + 1]
+    if start_i == end_i:
+        return
+    for off_x, off_y in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        ncx = cx + off_x
+        ncy = cy + off_y
+        if ncx < 0 or ncx >= cells_x or ncy < 0 or ncy >= cells_y:
             continue
-        cx = cell % cells_x
-        cy = cell // cells_x
-        start_i = cell_start[cell]
-        end_i = cell_end[cell]
+        neighbor_cell = ncx + ncy * cells_x
+        start_j = cell_start[neighbor_cell]
+        end_j = cell_start[neighbor_cell + 1]
         for a in range(start_i, end_i):
             i = sorted_indices[a]
-            for b in range(a + 1, end_i):
+            for b in range(a + 1 if neighbor_cell == cell else start_j, end_j):
                 j = sorted_indices[b]
-                dx = pos[j, 0] - pos[i, 0]
-                dy = pos[j, 1] - pos[i, 1]
+                if (i >= n_own) == (j >= n_own):
+                    continue
+                own = i if j >= n_own else j
+                ghost = i + j - own
+                asleep_own = still[own] >= sleep_after
+                asleep_ghost = still[ghost] >= sleep_after
+                if asleep_own and asleep_ghost:
+                    continue
+                dx = pos[own, 0] - pos[ghost, 0]
+                dy = pos[own, 1] - pos[ghost, 1]
                 dist = math.sqrt(dx * dx + dy * dy)
-                min_dist = radii[i] + radii[j]
-                if dist < min_dist:
-                    if dist > 0.0:
-                        overlap = min_dist - dist
-                        nx = dx / dist
-                        ny = dy / dist
-                        shift = overlap * factor
-                        pos[i, 0] -= nx * shift
-                        pos[i, 1] -= ny * shift
-                        pos[j, 0] += nx * shift
-                        pos[j, 1] += ny * shift
-                    else:
-                        shift = min_dist * factor
-                        pos[i, 0] -= shift
-                        pos[j, 0] += shift
-        # Process neighbor-cell collisions.
-        for off_x, off_y in ((1, -1), (1, 0), (1, 1), (0, 1)):
-            ncx = cx + off_x
-            ncy = cy + off_y
-            if ncx < 0 or ncx >= cells_x or ncy < 0 or ncy >= cells_y:
-                continue
-            neighbor_cell = ncx + ncy * cells_x
-            if cell_start[neighbor_cell] == -1:
+                min_dist = radii[own] + radii[ghost]
+                # Coincident centres give no direction both strips agree on; gravity parts them.
+                if dist >= min_dist or dist == 0.0:
+                    continue
+                overlap = min_dist - dist
+                share = factor * (1 - asleep_own)
+                push[own, 0] += dx / dist * overlap * share
+                push[own, 1] += dy / dist * overlap * share
+                if overlap > wake_depth and (asleep_own or asleep_ghost):
+                    still[own] = 0
+
+@numba.njit(cache=True)
+def resolve_cell_owned(pos, radii, still, n_own, sleep_after, wake_depth, sorted_indices, cell_start,
+                       cx, cy, cells_x, cells_y, factor):
+    """
+    resolve_cell_sleeping for cells next to a strip edge, skipping every pair
+    that involves a ghost; push_from_ghosts deals with those.
+    """
+    cell = cx + cy * cells_x
+    start_i = cell_start[cell]
+    end_i = cell_start[cell + 1]
+    if start_i == end_i:
+        return
+    for off_x, off_y in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        ncx = cx + off_x
+        ncy = cy + off_y
+        if ncx < 0 or ncx >= cells_x or ncy < 0 or ncy >= cells_y:
+            continue
+        neighbor_cell = ncx + ncy * cells_x
+        start_j = cell_start[neighbor_cell]
+        end_j = cell_start[neighbor_cell + 1]
+        for a in range(start_i, end_i):
+            i = sorted_indices[a]
+            if i >= n_own:
                 continue
-            start_j = cell_start[neighbor_cell]
-            end_j = cell_end[neighbor_cell]
-            for a in range(start_i, end_i):
+            asleep_i = still[i] >= sleep_after
+            for b in range(a + 1 if neighbor_cell == cell else start_j, end_j):
+                j = sorted_indices[b]
+                if j >= n_own:
+                    continue
+                asleep_j = still[j] >= sleep_after
+                if asleep_i and asleep_j:
+                    continue
+                share_i = factor * (1 - asleep_i)
+                share_j = factor * (1 - asleep_j)
+                overlap = resolve_pair(pos, radii, i, j, share_i, share_j)
+                if overlap > wake_depth and (asleep_i or asleep_j):
+                    still[i] = 0
+                    still[j] = 0
+
+@numba.njit(cache=True)
+def collision_detection_strip(pos, radii, still, n_own, n_balls, sleep_after, wake_depth, origin_x, cell_size,
+                              cells_x, cells_y, ghost_columns, cell_ids, cell_start, sorted_indices, cell_state, push):
+    """
+    collision_detection for one strip of a domain-decomposed run, on a grid
+    starting at origin_x. Balls from n_own to n_balls are ghosts, which lie in
+    the ghost_columns outermost columns on either side. Pairs with a ghost are
+    resolved first, all from the positions both strips saw, then the rest as
+    usual; only cells that touch ghost columns take the slower paths. push
+    is scratch with a row per ball.
+    """
+    build_grid(pos, n_balls, cell_size, cells_x, cells_y, cell_ids, cell_start, sorted_indices, origin_x)
+    mark_awake_cells(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state)
+    factor = 0.3
+    edge_columns = (0, ghost_columns + 1, cells_x - ghost_columns - 1, cells_x)
+    for k in range(0, 4, 2):
+        for c in range(edge_columns[k] * cells_y, edge_columns[k + 1] * cells_y):
+            cell = c // cells_y + (c % cells_y) * cells_x
+            for a in range(cell_start[cell], cell_start[cell + 1]):
+                push[sorted_indices[a], 0] = 0.0
+                push[sorted_indices[a], 1] = 0.0
+    for cy in range(cells_y):
+        for cx in range(cells_x):
+            if cx < ghost_columns or cx >= cells_x - ghost_columns - 1:
+                push_from_ghosts(pos, radii, still, n_own, sleep_after, wake_depth, sorted_indices, cell_start,
+                                 cx, cy, cells_x, cells_y, factor, push)
+    for k in range(0, 4, 2):
+        for c in range(edge_columns[k] * cells_y, edge_columns[k + 1] * cells_y):
+            cell = c // cells_y + (c % cells_y) * cells_x
+            for a in range(cell_start[cell], cell_start[cell + 1]):
                 i = sorted_indices[a]
-                for b in range(start_j, end_j):
-                    j = sorted_indices[b]
-                    dx = pos[j, 0] - pos[i, 0]
-                    dy = pos[j, 1] - pos[i, 1]
-                    dist = math.sqrt(dx * dx + dy * dy)
-                    min_dist = radii[i] + radii[j]
-                    if dist < min_dist:
-                        if dist > 0.0:
-                            overlap = min_dist - dist
-                            nx = dx / dist
-                            ny = dy / dist
-                            shift = overlap * factor
-                            pos[i, 0] -= nx * shift
-                            pos[i, 1] -= ny * shift
-                            pos[j, 0] += nx * shift
-                            pos[j, 1] += ny * shift
-                        else:
-                            shift = min_dist * factor
-                            pos[i, 0] -= shift
-                            pos[j, 0] += shift
+                if i < n_own:
+                    pos[i, 0] += push[i, 0]
+                    pos[i, 1] += push[i, 1]
+    for cy in range(cells_y):
+        for cx in range(cells_x):
+            if cx < ghost_columns or cx >= cells_x - ghost_columns - 1:
+                resolve_cell_owned(pos, radii, still, n_own, sleep_after, wake_depth, sorted_indices, cell_start,
+                                   cx, cy, cells_x, cells_y, factor)
+                continue
+            state = cell_state[cx + cy * cells_x]
+            if state == AWAKE:
+                resolve_cell(pos, radii, sorted_indices, cell_start, cx, cy, cells_x, cells_y, factor)
+            elif state != ASLEEP:
+                resolve_cell_sleeping(pos, radii, still, sleep_after, wake_depth, sorted_indices, cell_start,
+                                      cx, cy, cells_x, cells_y, factor)
+    wake_near_moving(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state)
+
+@numba.njit(parallel=True, cache=True)
+def collision_detection_parallel(pos, radii, still, n_balls, sleep_after, wake_depth, cell_size, cells_x, cells_y,
+                                 cell_ids, cell_start, sorted_indices, cell_state):
+    """
+    Multi-core variant of collision_detection.
+    A cell only writes to balls in its own column and the column to its right,
+    so all even columns can be resolved concurrently, then all odd columns.
+    """
+    build_grid(pos, n_balls, cell_size, cells_x, cells_y, cell_ids, cell_start, sorted_indices)
+    mark_awake_cells(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state)
+    factor = 0.3
+    n_strips = (cells_x + 1) // 2
+    for colour in range(2):
+        for s in numba.prange(n_strips):
+            cx = 2 * s + colour
+            if cx >= cells_x:
+                continue
+            for cy in range(cells_y):
+                state = cell_state[cx + cy * cells_x]
+                if state == AWAKE:
+                    resolve_cell(pos, radii, sorted_indices, cell_start, cx, cy, cells_x, cells_y, factor)
+                elif state != ASLEEP:
+                    resolve_cell_sleeping(pos, radii, still, sleep_after, wake_depth, sorted_indices, cell_start,
+                                          cx, cy, cells_x, cells_y, factor)
+    wake_near_moving(still, sleep_after, n_balls, cells_x, cells_y, cell_ids, cell_state)
+
+@numba.njit(cache=True)
+def spawn_balls(pos, prev, ids, colors, anchor, still, n_balls, spouts, launch_dx, launch_dy, n_spawn, first_id,
+                palette):
+    """
+    Append n_spawn balls at the first spouts, coloured palette[first_id + k].
+    Returns the new ball count.
+    """
+    for k in range(n_spawn):
+        i = n_balls + k
+        pos[i, 0] = spouts[k, 0]
+        pos[i, 1] = spouts[k, 1]
+        prev[i, 0] = spouts[k, 0] - launch_dx
+        prev[i, 1] = spouts[k, 1] - launch_dy
+        ids[i] = first_id + k
+        colors[i, 0] = palette[first_id + k, 0]
+        colors[i, 1] = palette[first_id + k, 1]
+        colors[i, 2] = palette[first_id + k, 2]
+        anchor[i, 0] = spouts[k, 0]
+        anchor[i, 1] = spouts[k, 1]
+        still[i] = 0
+    return n_balls + n_spawn
+
+@numba.njit(cache=True)
+def step_frame(pos, prev, radii, ids, colors, anchor, still, n_balls, spouts, launch_dx, launch_dy, n_spawn, first_id,
+               palette, sub_steps, dt, width, height, gravity, settle, sleep_dist2, sleep_after, wake_depth,
+               cell_size, cells_x, cells_y, cell_ids, cell_start, sorted_indices, cell_state, parallel):
+    """
+    Advance one frame entirely in compiled code: spawn n_spawn balls, then run
+    every substep of integration and collision. Returns the new ball count.
+    """
+    n_balls = spawn_balls(pos, prev, ids, colors, anchor, still, n_balls, spouts, launch_dx, launch_dy, n_spawn,
+                          first_id, palette)
+    dt2 = dt * dt
+    for _ in range(sub_steps):
+        update_positions(pos, prev, radii, anchor, still, n_balls, dt, dt2, width, height, gravity, settle,
+                         sleep_dist2, sleep_after)
+        if parallel:
+            collision_detection_parallel(pos, radii, still, n_balls, sleep_after, wake_depth, cell_size,
+                                         cells_x, cells_y, cell_ids, cell_start, sorted_indices, cell_state)
+        else:
+            collision_detection(pos, radii, still, n_balls, sleep_after, wake_depth, cell_size,
+                                cells_x, cells_y, cell_ids, cell_start, sorted_indices, cell_state)
+    return n_balls
+
+@numba.njit(cache=True)
+def motion_stats(pos, prev, n_balls):
+    """
+    Sum and maximum of the squared per-substep displacement pos - prev.
+    Serial so the result, and anything decided from it, is reproducible.
+    """
+    total = 0.0
+    peak = 0.0
+    for i in range(n_balls):
+        dx = pos[i, 0] - prev[i, 0]
+        dy = pos[i, 1] - prev[i, 1]
+        d2 = dx * dx + dy * dy
+        total += d2
+        if d2 > peak:
+            peak = d2
+    return total, peak
+
+@numba.njit(cache=True)
+def choose_substeps(pos, prev, still, n_balls, sleep_after, dt, frame_dt, launch_speed, gravity, radius, max_move,
+                    max_sag, min_steps, max_steps):
+    """
+    Substep count for the next frame, from two CFL-style bounds over the
+    awake balls. Speed: neither the fastest ball, nor one launched at
+    launch_speed, may move more than max_move in a substep. Stacking: the
+    collision pass only partly undoes the gravity step, so the sag left in a
+    column of awake balls grows with its height and must stay below max_sag.
+    Speeds come from the last substep, which lasted dt.
+    """
+    peak = 0.0
+    top = np.inf
+    bottom = -np.inf
+    for i in range(n_balls):
+        if still[i] >= sleep_after:
+            continue
+        dx = pos[i, 0] - prev[i, 0]
+        dy = pos[i, 1] - prev[i, 1]
+        peak = max(peak, dx * dx + dy * dy)
+        top = min(top, pos[i, 1])
+        bottom = max(bottom, pos[i, 1])
+    speed = max(math.sqrt(peak) / dt, launch_speed) + gravity * frame_dt
+    steps = math.ceil(speed * frame_dt / max_move)
+    if bottom >= top:
+        rows = (bottom - top) / (2 * radius) + 1
+        steps = max(steps, math.ceil(frame_dt * math.sqrt(gravity * rows / max_sag)))
+    return min(max(int(steps), min_steps), max_steps)
+
+@numba.njit(parallel=True, cache=True)
+def change_substeps(pos, prev, still, n_balls, old_steps, new_steps):
+    """
+    Switch the substep length from frame/old_steps to frame/new_steps. Verlet
+    keeps velocity as the per-substep move pos - prev, so prev is moved to keep
+    the speed, and the quiet-substep counters are scaled to the same time.
+    """
+    ratio = old_steps / new_steps
+    for i in numba.prange(n_balls):
+        prev[i, 0] = pos[i, 0] - (pos[i, 0] - prev[i, 0]) * ratio
+        prev[i, 1] = pos[i, 1] - (pos[i, 1] - prev[i, 1]) * ratio
+        still[i] = still[i] * new_steps // old_steps
@@ -0,0 +1,384 @@
+import math
+import numpy as np
+import numba
+from particles import grow_rows
+
+TILE = 16  # Side in pixels of the squares LayeredRenderer refreshes
+UNDRAWN = np.iinfo(np.int32).min  # Drawn x of a slot that held no ball on the previous frame
+
+@numba.njit(cache=True)
+def is_hidden(x, y, hidden_points):
+    for k in range(hidden_points.shape[0]):
+        if abs(y - hidden_points[k, 1]) < 2 and abs(x - hidden_points[k, 0]) < 2:
+            return True
+    return False
+
+@numba.njit(cache=True)
+def fill_circle(frame, x, y, r, color, border_width, border_color):
+    """
+    Draw one ball of draw_circles.
+    """
+    height = frame.shape[0]
+    width = frame.shape[1]
+    r2 = r * r
+    inner = r - border_width
+    inner2 = inner * inner if inner > 0 else 0.0
+    ri = int(r) + 1
+    y0 = max(y - ri, 0)
+    y1 = min(y + ri, height)
+    x0 = max(x - ri, 0)
+    x1 = min(x + ri, width)
+    for py in range(y0, y1):
+        dy = py + 0.5 - y
+        for px in range(x0, x1):
+            dx = px + 0.5 - x
+            d2 = dx * dx + dy * dy
+            if d2 > r2:
+                continue
+            if border_width > 0 and d2 > inner2:
+                frame[py, px, 0] = border_color[0]
+                frame[py, px, 1] = border_color[1]
+                frame[py, px, 2] = border_color[2]
+            else:
+                frame[py, px, 0] = color[0]
+                frame[py, px, 1] = color[1]
+                frame[py, px, 2] = color[2]
+
+@numba.njit(cache=True)
+def draw_circles(frame, pos, radii, colors, n_balls, border_width, border_color, hidden_points):
+    """
+    Rasterize filled circles straight into an RGB framebuffer of shape
+    (height, width, 3). A pixel belongs to a circle when its centre lies
+    within the radius. With border_width > 0 the outer ring is drawn in
+    border_color. Balls within 2 pixels of any of hidden_points are skipped.
+    """
+    for i in range(n_balls):
+        x = int(pos[i, 0])
+        y = int(pos[i, 1])
+        if not is_hidden(x, y, hidden_points):
+            fill_circle(frame, x, y, radii[i], colors[i], border_width, border_color)
+
+@numba.njit(cache=True)
+def footprint_tiles(x, y, r, width, height):
+    """
+    Rows ty0:ty1 and columns tx0:tx1 of the tiles the pixels of a ball of
+    radius r at (x, y) can touch; empty when it is off screen.
+    """
+    ri = int(r) + 1
+    x0 = max(x - ri, 0)
+    x1 = min(x + ri, width)
+    y0 = max(y - ri, 0)
+    y1 = min(y + ri, height)
+    if x1 <= x0 or y1 <= y0:
+        return 0, 0, 0, 0
+    return y0 // TILE, (y1 - 1) // TILE + 1, x0 // TILE, (x1 - 1) // TILE + 1
+
+@numba.njit(cache=True)
+def mark_tiles(tiles, x, y, r, width, height):
+    ty0, ty1, tx0, tx1 = footprint_tiles(x, y, r, width, height)
+    for ty in range(ty0, ty1):
+        for tx in range(tx0, tx1):
+            tiles[ty, tx] = 1
+
+@numba.njit(cache=True)
+def touches_tiles(tiles, x, y, r, width, height):
+    ty0, ty1, tx0, tx1 = footprint_tiles(x, y, r, width, height)
+    for ty in range(ty0, ty1):
+        for tx in range(tx0, tx1):
+            if tiles[ty, tx]:
+                return True
+    return False
+
+@numba.njit(cache=True)
+def top_owner(tile_owner, x, y, r, width, height):
+    """
+    Latest slot baked into any tile a ball at (x, y) can touch, or -1.
+    """
+    top = -1
+    ty0, ty1, tx0, tx1 = footprint_tiles(x, y, r, width, height)
+    for ty in range(ty0, ty1):
+        for tx in range(tx0, tx1):
+            top = max(top, tile_owner[ty, tx])
+    return top
+
+@numba.njit(cache=True)
+def fill_circle_under(frame, owner, index, x, y, r, color, border_width, border_color):
+    """
+    fill_circle that leaves alone the pixels owned by a later slot than index.
+    """
+    height = frame.shape[0]
+    width = frame.shape[1]
+    r2 = r * r
+    inner = r - border_width
+    inner2 = inner * inner if inner > 0 else 0.0
+    ri = int(r) + 1
+    y0 = max(y - ri, 0)
+    y1 = min(y + ri, height)
+    x0 = max(x - ri, 0)
+    x1 = min(x + ri, width)
+    for py in range(y0, y1):
+        dy = py + 0.5 - y
+        for px in range(x0, x1):
+            dx = px + 0.5 - x
+            d2 = dx * dx + dy * dy
+            if d2 > r2 or owner[py, px] > index:
+                continue
+            if border_width > 0 and d2 > inner2:
+                frame[py, px, 0] = border_color[0]
+                frame[py, px, 1] = border_color[1]
+                frame[py, px, 2] = border_color[2]
+            else:
+                frame[py, px, 0] = color[0]
+                frame[py, px, 1] = color[1]
+                frame[py, px, 2] = color[2]
+
+@numba.njit(cache=True)
+def bake_circle(static, owner, index, x, y, r, color, border_width, border_color, tiles):
+    """
+    fill_circle limited to the set tiles, recording index as the owner of
+    every pixel it draws.
+    """
+    height = static.shape[0]
+    width = static.shape[1]
+    r2 = r * r
+    inner = r - border_width
+    inner2 = inner * inner if inner > 0 else 0.0
+    ri = int(r) + 1
+    y0 = max(y - ri, 0)
+    y1 = min(y + ri, height)
+    x0 = max(x - ri, 0)
+    x1 = min(x + ri, width)
+    for py in range(y0, y1):
+        dy = py + 0.5 - y
+        for px in range(x0, x1):
+            dx = px + 0.5 - x
+            d2 = dx * dx + dy * dy
+            if d2 > r2 or not tiles[py // TILE, px // TILE]:
+                continue
+            if border_width > 0 and d2 > inner2:
+                static[py, px, 0] = border_color[0]
+                static[py, px, 1] = border_color[1]
+                static[py, px, 2] = border_color[2]
+            else:
+                static[py, px, 0] = color[0]
+                static[py, px, 1] = color[1]
+                static[py, px, 2] = color[2]
+            owner[py, px] = index
+
+@numba.njit(cache=True)
+def scatter_by_key(ids, pos, radii, colors, n_balls, key_pos, key_radii, key_colors):
+    """
+    Copy the first n_balls balls to the rows their ids name.
+    """
+    for i in range(n_balls):
+        k = ids[i]
+        key_pos[k, 0] = pos[i, 0]
+        key_pos[k, 1] = pos[i, 1]
+        key_radii[k] = radii[i]
+        key_colors[k, 0] = colors[i, 0]
+        key_colors[k, 1] = colors[i, 1]
+        key_colors[k, 2] = colors[i, 2]
+
+@numba.njit(cache=True)
+def draw_layered(frame, static, owner, tile_owner, background, pos, radii, colors, n_balls, n_prev, border_width,
+                 border_color, hidden_points, bake_frames, motion_threshold, drawn_xy, drawn_r, drawn_colors,
+                 unchanged, baked, static_tiles, moving_tiles, dirty_tiles):
+    """
+    The work of LayeredRenderer.draw. dirty_tiles comes in holding the tiles
+    moving balls covered last frame plus any invalidated ones, and goes out
+    holding the ones they cover now. Returns False if no tile needed redrawing.
+    """
+    height = frame.shape[0]
+    width = frame.shape[1]
+    restack = False
+    moving = np.empty(n_balls, dtype=np.int32)
+    n_moving = 0
+    # A slot that moved further than motion_threshold or changed size or
+    # colour leaves the static layer; one that did not for bake_frames frames
+    # joins it. Either way its tiles of the layer go stale.
+    for i in range(max(n_balls, n_prev)):
+        if i >= n_balls:
+            if baked[i]:
+                mark_tiles(static_tiles, drawn_xy[i, 0], drawn_xy[i, 1], drawn_r[i], width, height)
+                baked[i] = 0
+                restack = True
+            drawn_xy[i, 0] = UNDRAWN
+            unchanged[i] = 0
+            continue
+        x = int(pos[i, 0])
+        y = int(pos[i, 1])
+        r = radii[i]
+        if (abs(x - drawn_xy[i, 0]) > motion_threshold or abs(y - drawn_xy[i, 1]) > motion_threshold
+                or r != drawn_r[i] or colors[i, 0] != drawn_colors[i, 0] or colors[i, 1] != drawn_colors[i, 1]
+                or colors[i, 2] != drawn_colors[i, 2]):
+            if baked[i]:
+                mark_tiles(static_tiles, drawn_xy[i, 0], drawn_xy[i, 1], drawn_r[i], width, height)
+                baked[i] = 0
+                restack = True
+            drawn_r[i] = r
+            drawn_colors[i, 0] = colors[i, 0]
+            drawn_colors[i, 1] = colors[i, 1]
+            drawn_colors[i, 2] = colors[i, 2]
+            unchanged[i] = 0
+        elif not baked[i]:
+            unchanged[i] += 1
+        if baked[i]:
+            continue
+        # Until it is baked the ball is drawn where it is; once baked it stays
+        # where it was, which only differs with a motion_threshold.
+        drawn_xy[i, 0] = x
+        drawn_xy[i, 1] = y
+        if is_hidden(x, y, hidden_points):
+            continue
+        if unchanged[i] >= bake_frames:
+            baked[i] = 1
+            mark_tiles(static_tiles, x, y, r, width, height)
+            restack = True
+        else:
+            mark_tiles(moving_tiles, x, y, r, width, height)
+            moving[n_moving] = i
+            n_moving += 1
+    # Stale tiles of the static layer are cleared and every baked ball that
+    # touches them is drawn again, in slot order as draw_circles would.
+    if restack:
+        for ty in range(static_tiles.shape[0]):
+            for tx in range(static_tiles.shape[1]):
+                if static_tiles[ty, tx]:
+                    tile_owner[ty, tx] = -1
+                    for py in range(ty * TILE, min((ty + 1) * TILE, height)):
+                        for px in range(tx * TILE, min((tx + 1) * TILE, width)):
+                            static[py, px, 0] = background[0]
+                            static[py, px, 1] = background[1]
+                            static[py, px, 2] = background[2]
+                            owner[py, px] = -1
+        for i in range(n_balls):
+            if baked[i] and touches_tiles(static_tiles, drawn_xy[i, 0], drawn_xy[i, 1], drawn_r[i], width, height):
+                bake_circle(static, owner, i, drawn_xy[i, 0], drawn_xy[i, 1], drawn_r[i], drawn_colors[i],
+                            border_width, border_color, static_tiles)
+                ty0, ty1, tx0, tx1 = footprint_tiles(drawn_xy[i, 0], drawn_xy[i, 1], drawn_r[i], width, height)
+                for ty in range(ty0, ty1):
+                    for tx in range(tx0, tx1):
+                        if static_tiles[ty, tx]:
+                            tile_owner[ty, tx] = i
+    # The frame is refreshed from the static layer wherever anything changed,
+    # and the moving balls go on top except under pixels of later baked slots,
+    # which only need looking for where such a slot was baked into the tile.
+    # Every tile a moving ball covers is among the refreshed ones.
+    changed = False
+    frame_bytes = frame.reshape(height * width * 3)
+    static_bytes = static.reshape(height * width * 3)
+    n_tx = dirty_tiles.shape[1]
+    for ty in range(dirty_tiles.shape[0]):
+        tx = 0
+        while tx < n_tx:
+            # Runs of neighbouring tiles are copied a pixel row at a time.
+            # Unsigned offsets let the copy compile to a plain memory copy.
+            start = tx
+            while tx < n_tx and (dirty_tiles[ty, tx] or static_tiles[ty, tx] or moving_tiles[ty, tx]):
+                tx += 1
+            if tx == start:
+                tx += 1
+                continue
+            changed = True
+            b0 = np.uint64(start * TILE * 3)
+            b1 = np.uint64(min(tx * TILE, width) * 3)
+            for py in range(ty * TILE, min((ty + 1) * TILE, height)):
+                row = np.uint64(py * width * 3)
+                for b in range(row + b0, row + b1):
+                    frame_bytes[b] = static_bytes[b]
+    for k in range(n_moving):
+        i = moving[k]
+        x = drawn_xy[i, 0]
+        y = drawn_xy[i, 1]
+        if top_owner(tile_owner, x, y, drawn_r[i], width, height) > i:
+            fill_circle_under(frame, owner, i, x, y, drawn_r[i], drawn_colors[i], border_width, border_color)
+        else:
+            fill_circle(frame, x, y, drawn_r[i], drawn_colors[i], border_width, border_color)
+    dirty_tiles[:] = moving_tiles
+    moving_tiles[:] = 0
+    static_tiles[:] = 0
+    return changed
+
+class LayeredRenderer:
+    """
+    draw_circles for scenes in which most balls have come to rest. A ball
+    that draws the same pixels for bake_frames frames in a row is baked
+    into a cached static layer; each frame then only redraws the TILE-sized
+    squares that moving balls cover now or covered on the previous frame, so
+    the rasterising follows the moving balls rather than all of them. A pixel
+    of the static layer remembers which ball drew it, so a moving ball still
+    goes under baked balls drawn after it and the output matches draw_circles
+    exactly. Balls are tracked by slot, or by the keys given as ids: then
+    storage reordered between frames leaves the static layer alone, and the
+    output matches draw_circles of the balls in key order. With a
+    motion_threshold, balls that move by at most that many pixels per frame
+    are baked too, and stay baked, drawn where they were baked, until they
+    are that far from it: cheaper for jittering piles, but no longer exact.
+
+    draw() must be given the same frame every time. Whatever else draws on it
+    must invalidate() the pixels it touched so the next frame restores them.
+    """
+
+    def __init__(self, width, height, background, border_width, border_color, hidden_points, bake_frames=15,
+                 motion_threshold=0):
+        self.background = np.array(background, dtype=np.uint8)
+        self.static = np.empty((height, width, 3), dtype=np.uint8)
+        self.static[:] = self.background
+        self.owner = np.full((height, width), -1, dtype=np.int32)  # Slot of the baked ball drawn at each pixel
+        tiles = (-(-height // TILE), -(-width // TILE))
+        self.tile_owner = np.full(tiles, -1, dtype=np.int32)  # Latest slot drawn at any pixel of each tile
+        self.border_width = border_width
+        self.border_color = border_color
+        self.hidden_points = hidden_points
+        self.bake_frames = bake_frames
+        self.motion_threshold = motion_threshold
+        self.static_tiles = np.zeros(tiles, dtype=np.uint8)
+        self.moving_tiles = np.zeros(tiles, dtype=np.uint8)
+        self.dirty_tiles = np.ones(tiles, dtype=np.uint8)  # The first frame is drawn in full
+        self.drawn_xy = np.full((0, 2), UNDRAWN, dtype=np.int32)  # Per slot: what it drew on the previous frame
+        self.drawn_r = np.zeros(0, dtype=np.float64)
+        self.drawn_colors = np.zeros((0, 3), dtype=np.uint8)
+        self.unchanged = np.zeros(0, dtype=np.int32)  # Frames in a row it drew the same pixels
+        self.baked = np.zeros(0, dtype=np.uint8)
+        self.count = 0
+        self.key_pos = np.zeros((0, 2), dtype=np.float64)  # The balls put in key order when draw() is given ids
+        self.key_radii = np.zeros(0, dtype=np.float64)
+        self.key_colors = np.zeros((0, 3), dtype=np.uint8)
+
+    def invalidate(self, x0, y0, x1, y1):
+        """
+        Have the next draw() restore the pixels in [x0, x1) x [y0, y1).
+        """
+        height, width = self.owner.shape
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(math.ceil(x1)), width), min(int(math.ceil(y1)), height)
+        if x1 > x0 and y1 > y0:
+            self.dirty_tiles[y0 // TILE:(y1 - 1) // TILE + 1, x0 // TILE:(x1 - 1) // TILE + 1] = 1
+
+    def draw(self, frame, pos, radii, colors, n_balls, ids=None):
+        """
+        Bring frame up to date with the first n_balls balls. ids, if given,
+        must hold a permutation of range(n_balls) that follows each ball
+        wherever it is stored. Returns False, leaving frame untouched, when
+        it would come out the same as before.
+        """
+        if ids is not None:
+            if n_balls > len(self.key_radii):
+                self.key_pos = grow_rows(self.key_pos, n_balls)
+                self.key_radii = grow_rows(self.key_radii, n_balls)
+                self.key_colors = grow_rows(self.key_colors, n_balls)
+            scatter_by_key(ids, pos, radii, colors, n_balls, self.key_pos, self.key_radii, self.key_colors)
+            pos, radii, colors = self.key_pos, self.key_radii, self.key_colors
+        if n_balls > len(self.baked):
+            self.drawn_xy = grow_rows(self.drawn_xy, n_balls, UNDRAWN)
+            self.drawn_r = grow_rows(self.drawn_r, n_balls)
+            self.drawn_colors = grow_rows(self.drawn_colors, n_balls)
+            self.unchanged = grow_rows(self.unchanged, n_balls)
+            self.baked = grow_rows(self.baked, n_balls)
+        changed = draw_layered(frame, self.static, self.owner, self.tile_owner, self.background, pos, radii, colors,
+                               n_balls, self.count, self.border_width, self.border_color, self.hidden_points,
+                               self.bake_frames, self.motion_threshold, self.drawn_xy, self.drawn_r,
+                               self.drawn_colors, self.unchanged, self.baked, self.static_tiles, self.moving_tiles,
+                               self.dirty_tiles)
+        self.count = n_balls
+        return changed
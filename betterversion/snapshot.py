@@ -0,0 +1,172 @@
+import numpy as np
+from particles import grow_rows
+
+class SnapshotRing:
+    """
+    Triple-buffered handoff of render snapshots from the simulation thread to
+    the render thread. The lock only guards slot bookkeeping; positions are
+    copied outside of it and only the live prefix of each buffer is touched.
+    Every slot carries the previous and the current frame positions so the
+    renderer can interpolate from a single slot, along with the radii, ids
+    and colours the balls are drawn with. Slots start at capacity
+    balls and grow when a bigger snapshot is published into them.
+    """
+
+    def __init__(self, capacity, lock, slots=3):
+        self.lock = lock
+        self.old = [np.zeros((capacity, 2), dtype=np.float32) for _ in range(slots)]
+        self.current = [np.zeros((capacity, 2), dtype=np.float32) for _ in range(slots)]
+        self.radii = [np.zeros(capacity, dtype=np.float32) for _ in range(slots)]
+        self.ids = [np.zeros(capacity, dtype=np.int32) for _ in range(slots)]
+        self.colors = [np.zeros((capacity, 3), dtype=np.uint8) for _ in range(slots)]
+        self.counts = [0] * slots
+        self.times = [0.0] * slots
+        self.latest = -1
+        self.reading = -1
+
+    def publish(self, pos, radii, ids, colors, n_balls, n_kept, order, timestamp):
+        """
+        Publish the first n_balls positions, radii, ids and colours. The first n_kept balls existed in
+        the previous snapshot; order is the permutation applied to them since
+        then (None if their slots did not move).
+        """
+        with self.lock:
+            slot = next(s for s in range(len(self.counts)) if s != self.latest and s != self.reading)
+            prev = self.latest
+        if len(self.current[slot]) < n_balls:
+            # Nobody reads this slot until it is published, so it can be replaced
+            self.old[slot] = grow_rows(self.old[slot], n_balls)
+            self.current[slot] = grow_rows(self.current[slot], n_balls)
+            self.radii[slot] = grow_rows(self.radii[slot], n_balls)
+            self.ids[slot] = grow_rows(self.ids[slot], n_balls)
+            self.colors[slot] = grow_rows(self.colors[slot], n_balls)
+        old = self.old[slot]
+        cur = self.current[slot]
+        cur[:n_balls] = pos[:n_balls]
+        self.radii[slot][:n_balls] = radii[:n_balls]
+        self.ids[slot][:n_balls] = ids[:n_balls]
+        self.colors[slot][:n_balls] = colors[:n_balls]
+        n_kept = min(n_kept, self.counts[prev]) if prev >= 0 else 0
+        if n_kept > 0:
+            src = self.current[prev][:n_kept]
+            old[:n_kept] = src[order] if order is not None else src
+        old[n_kept:n_balls] = cur[n_kept:n_balls]
+        with self.lock:
+            self.counts[slot] = n_balls
+            self.times[slot] = timestamp
+            self.latest = slot
+
+    def acquire(self):
+        """
+        Pin the newest snapshot for reading until release() is called.
+        Returns (n_balls, old, current, radii, ids, colors, timestamp) or None.
+        """
+        with self.lock:
+            slot = self.latest
+            if slot < 0:
+                return None
+            self.reading = slot
+            return (self.counts[slot], self.old[slot], self.current[slot], self.radii[slot], self.ids[slot],
+                    self.colors[slot], self.times[slot])
+
+    def release(self):
+        """
+        Unpin the snapshot. Returns True: the lock keeps a pinned slot intact.
+        """
+        with self.lock:
+            self.reading = -1
+        return True
+
+class SharedSnapshotRing:
+    """
+    SnapshotRing for a simulation running in another process, forked after
+    this is created: every slot lives in one multiprocessing.shared_memory
+    block, so the renderer reads positions and colours where the simulation
+    wrote them. There is no lock between the processes. Each slot carries a
+    sequence number that is odd while the slot is being written, and
+    release() reports whether it changed while the slot was pinned, in which
+    case what was read may be torn; anything used after release() must be
+    copied out before it, or the check does not cover it. The writer skips the newest slot and the
+    pinned one, so with four slots that takes a reader several frames behind.
+    Capacity is fixed. state holds int64 scalars the two sides share.
+    """
+
+    def __init__(self, capacity, slots=4, state_size=8):
+        capacity = max(capacity, 1)
+        fields = [("latest", np.int64, (2,)), ("seqs", np.int64, (slots,)), ("counts", np.int64, (slots,)),
+                  ("times", np.float64, (slots,)), ("state", np.int64, (state_size,)),
+                  ("old", np.float32, (slots, capacity, 2)), ("current", np.float32, (slots, capacity, 2)),
+                  ("radii", np.float32, (slots, capacity)), ("ids", np.int32, (slots, capacity)),
+                  ("colors", np.uint8, (slots, capacity, 3))]
+        sizes = [-(-np.dtype(dtype).itemsize * int(np.prod(shape)) // 64) * 64 for _, dtype, shape in fields]
+        from multiprocessing import shared_memory  # Here, so that the thread modes never load multiprocessing
+        self.shm = shared_memory.SharedMemory(create=True, size=sum(sizes))
+        offset = 0
+        for (name, dtype, shape), size in zip(fields, sizes):
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+            offset += size
+        self.latest[:] = -1  # Newest slot, slot pinned by the reader
+        self.seqs[:] = 0
+        self.state[:] = 0
+        self.capacity = capacity
+        self.pinned = None
+
+    def publish(self, pos, radii, ids, colors, n_balls, n_kept, order, timestamp):
+        """
+        Same as SnapshotRing.publish, but n_balls must fit the capacity.
+        """
+        if n_balls > self.capacity:
+            raise ValueError(f"snapshot of {n_balls} balls exceeds the shared ring's {self.capacity}")
+        prev, reading = int(self.latest[0]), int(self.latest[1])
+        slot = next(s for s in range(len(self.seqs)) if s != prev and s != reading)
+        self.seqs[slot] += 1
+        old = self.old[slot]
+        cur = self.current[slot]
+        cur[:n_balls] = pos[:n_balls]
+        self.radii[slot][:n_balls] = radii[:n_balls]
+        self.ids[slot][:n_balls] = ids[:n_balls]
+        self.colors[slot][:n_balls] = colors[:n_balls]
+        n_kept = min(n_kept, int(self.counts[prev])) if prev >= 0 else 0
+        if n_kept > 0:
+            src = self.current[prev][:n_kept]
+            old[:n_kept] = src[order] if order is not None else src
+        old[n_kept:n_balls] = cur[n_kept:n_balls]
+        self.counts[slot] = n_balls
+        self.times[slot] = timestamp
+        self.seqs[slot] += 1
+        self.latest[0] = slot
+
+    def acquire(self):
+        """
+        Pin the newest snapshot and return views of it, as SnapshotRing.acquire.
+        """
+        slot = int(self.latest[0])
+        if slot < 0:
+            return None
+        self.latest[1] = slot
+        seq = int(self.seqs[slot])
+        if seq % 2 == 1:
+            # Rewritten since it was the newest: the reader is far behind, try again next frame
+            self.latest[1] = -1
+            return None
+        self.pinned = (slot, seq)
+        return (int(self.counts[slot]), self.old[slot], self.current[slot], self.radii[slot], self.ids[slot],
+                self.colors[slot], float(self.times[slot]))
+
+    def release(self):
+        """
+        Unpin the snapshot. Returns False if it was overwritten while pinned.
+        """
+        slot, seq = self.pinned
+        self.latest[1] = -1
+        self.pinned = None
+        return int(self.seqs[slot]) == seq
+
+    def close(self):
+        """
+        Unmap the block and remove it; call once the other process is done with it.
+        """
+        del self.latest, self.seqs, self.counts, self.times, self.state, self.old, self.current, self.radii, self.ids, \
+            self.colors
+        self.shm.close()
+        self.shm.unlink()
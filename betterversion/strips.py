@@ -0,0 +1,386 @@
+import math
+import signal
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import numba
+from physicsengine import allocate_grid, update_positions, collision_detection_strip, change_substeps
+
+GHOST_COLUMNS = 2  # Grid columns of halo each side of a strip; must cover two radii plus a substep's move
+BALL_FIELDS = (("pos", np.float32, (2,)), ("prev", np.float32, (2,)), ("radii", np.float32, ()),
+               ("ids", np.int32, ()), ("colors", np.uint8, (3,)), ("anchors", np.float32, (2,)),
+               ("still", np.int32, ()))  # ParticleStore.arrays() order
+# Control block: what the next frame should do, written by the main process.
+SPAWN, FIRST_ID, SUB_STEPS, OLD_STEPS, SLEEP_AFTER, STOP = range(6)
+LAUNCH_DX, LAUNCH_DY, DT = range(3)
+# Per-strip counts: owned balls, then migrants and halo balls in the left box, then in the right box.
+OWNED = 0
+
+def aligned(nbytes):
+    return -(-nbytes // 64) * 64
+
+class SharedBalls:
+    """
+    The per-ball arrays of a ParticleStore for rows balls, viewing a shared
+    memory buffer from offset on. end is where the next block can start.
+    """
+
+    def __init__(self, buffer, offset, rows):
+        for name, dtype, shape in BALL_FIELDS:
+            arr = np.ndarray((rows,) + shape, dtype=dtype, buffer=buffer, offset=offset)
+            setattr(self, name, arr)
+            offset += aligned(arr.nbytes)
+        self.end = offset
+
+    @staticmethod
+    def nbytes(rows):
+        return sum(aligned(rows * np.dtype(dtype).itemsize * math.prod(shape)) for _, dtype, shape in BALL_FIELDS)
+
+    def arrays(self):
+        return tuple(getattr(self, name) for name, _, _ in BALL_FIELDS)
+
+class Strip:
+    """
+    One strip's shared block: its counts, its own balls with room for ghosts
+    behind them, and a box per side that it fills each substep with the balls
+    leaving towards that neighbour followed by its halo for that neighbour.
+    """
+
+    def __init__(self, shm, capacity, box_capacity):
+        self.shm = shm
+        self.capacity = capacity
+        self.box_capacity = box_capacity
+        self.counts = np.ndarray(5, dtype=np.int64, buffer=shm.buf)
+        self.balls = SharedBalls(shm.buf, 64, capacity + 4 * box_capacity)
+        left = SharedBalls(shm.buf, self.balls.end, box_capacity)
+        self.boxes = (left, SharedBalls(shm.buf, left.end, box_capacity))
+
+    @staticmethod
+    def nbytes(capacity, box_capacity):
+        return 64 + SharedBalls.nbytes(capacity + 4 * box_capacity) + 2 * SharedBalls.nbytes(box_capacity)
+
+    def box_counts(self, side):
+        return int(self.counts[1 + 2 * side]), int(self.counts[2 + 2 * side])
+
+def remove_rows(arrays, n, rows):
+    """
+    Drop the sorted slot indices rows from the first n slots by moving the
+    last kept balls into the holes. Returns the new count.
+    """
+    kept = n - len(rows)
+    holes = rows[rows < kept]
+    movers = np.setdiff1d(np.arange(kept, n), rows, assume_unique=True)
+    for arr in arrays:
+        arr[holes] = arr[movers]
+    return kept
+
+class StripSimulation:
+    """
+    step_frame spread over `workers` processes, each owning one vertical strip
+    of the canvas and the balls whose centre lies in it. Every substep a
+    strip integrates its balls, hands those that crossed an edge to the
+    neighbour and publishes a halo of the balls within GHOST_COLUMNS cells of
+    each edge; collisions then run against the neighbours' halos as ghosts,
+    each side of a pair moving only its own ball, see collision_detection_strip.
+    Strips split the width because the pile grows from the bottom, so every
+    strip has work all along. Results are deterministic for a given worker
+    count but differ from a single-process run, where the pairs are resolved
+    in a different order. Create it before any parallel kernel has run in
+    this process: forking while numba's worker threads exist can hang.
+    """
+
+    def __init__(self, workers, width, height, cell_size, radius, spouts, gravity, sleep_dist2, wake_depth):
+        total_cells = int(width // cell_size) + 1
+        strip_cells = -(-total_cells // workers)
+        if strip_cells < 2 * GHOST_COLUMNS or (workers - 1) * strip_cells >= total_cells:
+            raise ValueError(f"{width}px is too narrow for {workers} strips")
+        ball_area = math.pi * radius ** 2
+        edges = [k * strip_cells * cell_size for k in range(workers)] + [width]
+        capacity = int((strip_cells + 2 * GHOST_COLUMNS) * cell_size * height / ball_area * 1.25) + len(spouts)
+        box_capacity = int((GHOST_COLUMNS + 1) * cell_size * height / ball_area * 1.25) + len(spouts)
+        nbytes = Strip.nbytes(capacity, box_capacity)
+        self.shms = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(workers)]
+        self.control_shm = shared_memory.SharedMemory(create=True, size=128 + aligned(len(spouts) * 3))
+        self.strips = [Strip(shm, capacity, box_capacity) for shm in self.shms]
+        self.ints, self.floats, self.spawn_colors = control_arrays(self.control_shm, len(spouts))
+        for strip in self.strips:
+            strip.counts[:] = 0
+        self.edges = edges
+        self.count = 0
+        self.steps = 1
+        # Fork where possible: the workers need none of the parent's state and spawn would re-run main.py.
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        self.frame_barrier = context.Barrier(workers + 1)
+        step_barrier = context.Barrier(workers)
+        setup = {"names": [shm.name for shm in self.shms], "control": self.control_shm.name,
+                 "capacity": capacity, "box_capacity": box_capacity, "edges": edges, "strip_cells": strip_cells,
+                 "width": width, "height": height, "cell_size": cell_size, "radius": radius,
+                 "spouts": np.asarray(spouts, dtype=np.float32), "gravity": gravity, "sleep_dist2": sleep_dist2,
+                 "wake_depth": wake_depth}
+        self.processes = [context.Process(target=run_strip, args=(setup, k, self.frame_barrier, step_barrier),
+                                          daemon=True) for k in range(workers)]
+        for process in self.processes:
+            process.start()
+
+    def scatter(self, store, n_balls, sub_steps):
+        """
+        Hand the first n_balls balls of a ParticleStore to the strips their
+        centres lie in. Their velocities are per substep of sub_steps.
+        """
+        x = store.pos[:n_balls, 0]
+        for k, strip in enumerate(self.strips):
+            lo = self.edges[k] if k > 0 else -np.inf
+            hi = self.edges[k + 1] if k < len(self.strips) - 1 else np.inf
+            rows = np.flatnonzero((x >= lo) & (x < hi))
+            if len(rows) > strip.capacity:
+                raise RuntimeError(f"strip {k} cannot hold {len(rows)} balls, use fewer strip workers")
+            for dst, src in zip(strip.balls.arrays(), store.arrays()):
+                dst[:len(rows)] = src[rows]
+            strip.counts[OWNED] = len(rows)
+        self.count = n_balls
+        self.steps = sub_steps
+
+    def gather(self, store):
+        """
+        Copy every strip's balls into a ParticleStore, each in the slot of its
+        spawn index so that slots stay put from one frame to the next.
+        """
+        for strip in self.strips:
+            n = int(strip.counts[OWNED])
+            slots = strip.balls.ids[:n]
+            for dst, src in zip(store.arrays(), strip.balls.arrays()):
+                dst[slots] = src[:n]
+
+    def step(self, n_spawn, first_id, spawn_colors, launch_dx, launch_dy, sub_steps, dt, sleep_after):
+        """
+        Run one frame like step_frame, spawning n_spawn balls coloured
+        spawn_colors at the first spouts. Returns the new ball count.
+        """
+        self.ints[[SPAWN, FIRST_ID, SUB_STEPS, OLD_STEPS, SLEEP_AFTER]] = \
+            n_spawn, first_id, sub_steps, self.steps, sleep_after
+        self.floats[[LAUNCH_DX, LAUNCH_DY, DT]] = launch_dx, launch_dy, dt
+        self.spawn_colors[:n_spawn] = spawn_colors[:n_spawn]
+        try:
+            self.frame_barrier.wait()
+            self.frame_barrier.wait()
+        except threading.BrokenBarrierError:
+            raise RuntimeError("a strip worker failed, see its traceback above") from None
+        self.steps = sub_steps
+        self.count = sum(int(strip.counts[OWNED]) for strip in self.strips)
+        return self.count
+
+    def close(self):
+        self.ints[STOP] = 1
+        try:
+            self.frame_barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        del self.strips, self.ints, self.floats, self.spawn_colors
+        for shm in self.shms + [self.control_shm]:
+            shm.close()
+            shm.unlink()
+
+def control_arrays(shm, n_spouts):
+    ints = np.ndarray(8, dtype=np.int64, buffer=shm.buf)
+    floats = np.ndarray(4, dtype=np.float64, buffer=shm.buf, offset=64)
+    spawn_colors = np.ndarray((n_spouts, 3), dtype=np.uint8, buffer=shm.buf, offset=128)
+    return ints, floats, spawn_colors
+
+def run_strip(setup, index, frame_barrier, step_barrier):
+    """
+    Worker process body: simulate strip index one frame per frame_barrier
+    round until told to stop. A failure breaks both barriers so that the main
+    process and the other strips do not wait forever.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the main process
+    numba.set_num_threads(1)
+    shms = [shared_memory.SharedMemory(name=name) for name in setup["names"]]
+    control_shm = shared_memory.SharedMemory(name=setup["control"])
+    try:
+        worker = StripWorker(setup, index, shms, control_shm, step_barrier)
+        worker.warmup()
+        while True:
+            frame_barrier.wait()
+            if worker.ints[STOP]:
+                break
+            worker.frame()
+            frame_barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    except BaseException:
+        frame_barrier.abort()
+        step_barrier.abort()
+        raise
+
+class StripWorker:
+    """
+    The state one worker process keeps between frames: views of every
+    strip's shared block, its own edges and its own collision grid.
+    """
+
+    def __init__(self, setup, index, shms, control_shm, step_barrier):
+        self.strips = [Strip(shm, setup["capacity"], setup["box_capacity"]) for shm in shms]
+        self.strip = self.strips[index]
+        last = len(self.strips) - 1
+        self.neighbours = (self.strips[index - 1] if index > 0 else None,
+                           self.strips[index + 1] if index < last else None)
+        edges = setup["edges"]
+        self.lo = edges[index] if index > 0 else -np.inf
+        self.hi = edges[index + 1] if index < last else np.inf
+        self.index = index
+        self.step_barrier = step_barrier
+        self.ints, self.floats, self.spawn_colors = control_arrays(control_shm, len(setup["spouts"]))
+        self.width = setup["width"]
+        self.height = setup["height"]
+        self.gravity = setup["gravity"]
+        self.sleep_dist2 = setup["sleep_dist2"]
+        self.wake_depth = setup["wake_depth"]
+        cell_size = setup["cell_size"]
+        self.cell_size = cell_size
+        self.band = GHOST_COLUMNS * cell_size
+        self.origin = edges[index] - self.band
+        self.cells_x = math.ceil((edges[index + 1] - edges[index]) / cell_size) + 2 * GHOST_COLUMNS
+        self.cells_y = int(self.height // cell_size) + 1
+        self.grid = allocate_grid(len(self.strip.balls.pos), self.cells_x, self.cells_y)
+        self.push = np.zeros((len(self.strip.balls.pos), 2), dtype=np.float32)
+        spouts = setup["spouts"]
+        self.spouts = spouts
+        self.radius = setup["radius"]
+        mine = np.flatnonzero((spouts[:, 0] >= self.lo) & (spouts[:, 0] < self.hi))
+        self.spout_range = (mine[0], mine[-1] + 1) if len(mine) > 0 else (0, 0)
+
+    def warmup(self):
+        """
+        Compile this worker's kernels, or load them from numba's on-disk
+        cache, by running each on zero balls before the first frame.
+        """
+        balls = self.strip.balls
+        change_substeps(balls.pos, balls.prev, balls.still, 0, 1, 1)
+        update_positions(balls.pos, balls.prev, balls.radii, balls.anchors, balls.still, 0, 1.0, 1.0,
+                         self.width, self.height, self.gravity, False, self.sleep_dist2, 1)
+        collision_detection_strip(balls.pos, balls.radii, balls.still, 0, 0, 1, self.wake_depth, self.origin,
+                                  self.cell_size, self.cells_x, self.cells_y, GHOST_COLUMNS, *self.grid, self.push)
+
+    def frame(self):
+        strip = self.strip
+        balls = strip.balls
+        n = int(strip.counts[OWNED])
+        sub_steps = int(self.ints[SUB_STEPS])
+        old_steps = int(self.ints[OLD_STEPS])
+        sleep_after = int(self.ints[SLEEP_AFTER])
+        dt = float(self.floats[DT])
+        if old_steps != sub_steps:
+            change_substeps(balls.pos, balls.prev, balls.still, n, old_steps, sub_steps)
+        n = self.spawn(n)
+        for _ in range(sub_steps):
+            update_positions(balls.pos, balls.prev, balls.radii, balls.anchors, balls.still, n, dt, dt * dt,
+                             self.width, self.height, self.gravity, False, self.sleep_dist2, sleep_after)
+            n = self.publish(n)
+            self.step_barrier.wait()
+            n, n_ghosts = self.receive(n)
+            self.step_barrier.wait()
+            collision_detection_strip(balls.pos, balls.radii, balls.still, n, n + n_ghosts, sleep_after,
+                                      self.wake_depth, self.origin, self.cell_size, self.cells_x, self.cells_y,
+                                      GHOST_COLUMNS, *self.grid, self.push)
+        strip.counts[OWNED] = n
+
+    def spawn(self, n):
+        """
+        Append the balls of this frame's spawn that start at this strip's spouts.
+        """
+        a = self.spout_range[0]
+        b = min(self.spout_range[1], int(self.ints[SPAWN]))
+        if b <= a:
+            return n
+        self.check_room(n + b - a)
+        balls = self.strip.balls
+        rows = slice(n, n + b - a)
+        spouts = self.spouts[a:b]
+        balls.pos[rows] = spouts
+        balls.prev[rows] = spouts - self.floats[[LAUNCH_DX, LAUNCH_DY]]
+        balls.radii[rows] = self.radius
+        balls.ids[rows] = self.ints[FIRST_ID] + np.arange(a, b)
+        balls.colors[rows] = self.spawn_colors[a:b]
+        balls.anchors[rows] = spouts
+        balls.still[rows] = 0
+        return n + b - a
+
+    def publish(self, n):
+        """
+        Fill each side's box with the balls that crossed that edge, then the
+        halo of balls within band of it, and drop the crossed ones from this
+        strip. Returns the new count.
+        """
+        strip = self.strip
+        arrays = strip.balls.arrays()
+        x = strip.balls.pos[:n, 0]
+        leaving = []
+        for side, edge in enumerate((self.lo, self.hi)):
+            if self.neighbours[side] is None:
+                continue
+            if side == 0:
+                crossed = x < edge
+                near = x < edge + self.band
+            else:
+                crossed = x >= edge
+                near = x >= edge - self.band
+            rows = np.flatnonzero(crossed)
+            halo = np.flatnonzero(near & ~crossed)
+            if len(rows) + len(halo) > strip.box_capacity:
+                raise RuntimeError(f"strip {self.index} overflowed its halo box")
+            for dst, src in zip(strip.boxes[side].arrays(), arrays):
+                dst[:len(rows)] = src[rows]
+                dst[len(rows):len(rows) + len(halo)] = src[halo]
+            strip.counts[1 + 2 * side] = len(rows)
+            strip.counts[2 + 2 * side] = len(halo)
+            leaving.append(rows)
+        if leaving:
+            rows = np.concatenate(leaving)
+            if len(rows) > 0:
+                n = remove_rows(arrays, n, np.sort(rows))
+        return n
+
+    def receive(self, n):
+        """
+        Take over the balls the neighbours handed to this strip, then append
+        ghosts behind them: the neighbours' halos, and copies of the balls this
+        strip just handed over, which its own balls still touch. Returns the
+        new count and the number of ghosts.
+        """
+        strip = self.strip
+        balls = strip.balls
+        for side, neighbour in enumerate(self.neighbours):
+            if neighbour is None:
+                continue
+            moved, _ = neighbour.box_counts(1 - side)
+            if moved > 0:
+                self.check_room(n + moved)
+                for dst, src in zip(balls.arrays(), neighbour.boxes[1 - side].arrays()):
+                    dst[n:n + moved] = src[:moved]
+                n += moved
+        end = n
+        for side, neighbour in enumerate(self.neighbours):
+            if neighbour is None:
+                continue
+            moved, halo = neighbour.box_counts(1 - side)
+            end = self.copy_ghosts(end, neighbour.boxes[1 - side], moved, moved + halo)
+            moved, _ = strip.box_counts(side)
+            end = self.copy_ghosts(end, strip.boxes[side], 0, moved)
+        return n, end - n
+
+    def copy_ghosts(self, end, box, start, stop):
+        balls = self.strip.balls
+        count = stop - start
+        balls.pos[end:end + count] = box.pos[start:stop]
+        balls.radii[end:end + count] = box.radii[start:stop]
+        balls.still[end:end + count] = box.still[start:stop]
+        return end + count
+
+    def check_room(self, n):
+        if n > self.strip.capacity:
+            raise RuntimeError(f"strip {self.index} cannot hold {n} balls, use fewer strip workers")
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+
+class TimedLock:
+    """
+    Drop-in for threading.Lock in `with` blocks that adds up how long each
+    thread waited to get it. take_wait() returns and clears the calling
+    thread's total.
+    """
+
+    def __init__(self, lock=None):
+        self.lock = lock if lock is not None else threading.Lock()
+        self.waits = {}
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        ident = threading.get_ident()
+        self.waits[ident] = self.waits.get(ident, 0.0) + time.perf_counter() - start
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+    def take_wait(self):
+        return self.waits.pop(threading.get_ident(), 0.0)
+
+class Telemetry:
+    """
+    Per-frame trace written as JSON lines. Every record carries its source
+    ("sim" or "render"), the seconds since start and whatever values the
+    caller passes, usually stage durations in ms. Threads may record
+    concurrently. summary() gives the mean of every value per source since
+    its previous call, for a progress bar postfix.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "w", buffering=1)  # Whole lines, so a forked simulation process can share it
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.sums = {}
+        self.counts = {}
+
+    def record(self, source, **values):
+        line = json.dumps({"source": source, "t": round(time.perf_counter() - self.start, 6), **values})
+        with self.lock:
+            self.file.write(line + "\n")
+            sums = self.sums.setdefault(source, {})
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    sums[key] = sums.get(key, 0.0) + value
+            self.counts[source] = self.counts.get(source, 0) + 1
+
+    def summary(self, source, keys):
+        with self.lock:
+            sums = self.sums.pop(source, {})
+            count = self.counts.pop(source, 0)
+        if count == 0:
+            return ""
+        return " ".join(f"{key} {sums.get(key, 0.0) / count:.2f}" for key in keys)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+import numpy as np
+
+def config_key(config):
+    """
+    Stable short hash of a dict of physics settings.
+    """
+    blob = json.dumps(config, sort_keys=True).encode()
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+class TrajectoryWriter:
+    """
+    Append per-frame ball positions to a cache directory. Positions are stored
+    in spawn order as uint16 fixed point, so a frame is 4 bytes per ball and
+    any image's colours line up with it by spawn index. The positions the
+    colours were sampled at are kept as they were, since a quantized one
+    can land on a neighbouring pixel. The directory only appears under its
+    final name once close() has been called.
+    """
+
+    def __init__(self, root, key, width, height, config):
+        self.path = os.path.join(root, key)
+        self.partial = self.path + ".partial"
+        shutil.rmtree(self.partial, ignore_errors=True)
+        os.makedirs(self.partial)
+        self.scale = 2 ** int(math.log2(65535 / max(width, height)))
+        self.limit = np.array((width, height), dtype=np.float32)
+        self.meta = {"key": key, "width": width, "height": height, "scale": self.scale, "config": config}
+        self.counts = []
+        self.positions = open(os.path.join(self.partial, "positions.u16"), "wb")
+        self.scratch = None
+
+    def append(self, pos, ids, n_balls):
+        if self.scratch is None or len(self.scratch) < n_balls:
+            self.scratch = np.empty((max(n_balls, 1024) * 2, 2), dtype=np.uint16)
+        frame = self.scratch[:n_balls]
+        q = np.clip(pos[:n_balls], 0, self.limit) * self.scale
+        frame[ids[:n_balls]] = np.minimum(q, 65535)
+        frame.tofile(self.positions)
+        self.counts.append(n_balls)
+
+    def set_sample(self, pos, ids, n_balls):
+        sample = np.empty((n_balls, 2), dtype=np.float32)
+        sample[ids[:n_balls]] = pos[:n_balls]
+        np.save(os.path.join(self.partial, "sample.npy"), sample)
+
+    def close(self):
+        self.positions.close()
+        np.save(os.path.join(self.partial, "counts.npy"), np.array(self.counts, dtype=np.int64))
+        self.meta["frames"] = len(self.counts)
+        with open(os.path.join(self.partial, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=4)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.partial, self.path)
+
+    def abort(self):
+        self.positions.close()
+        shutil.rmtree(self.partial, ignore_errors=True)
+
+class TrajectoryReader:
+    """
+    Memory-mapped view of a finished trajectory cache entry.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.scale = self.meta["scale"]
+        self.counts = np.load(os.path.join(path, "counts.npy"))
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        # Positions in spawn order the colours were sampled at; None if phase 1 was skipped
+        sample_path = os.path.join(path, "sample.npy")
+        self.sample = np.load(sample_path) if os.path.exists(sample_path) else None
+        total = int(self.offsets[-1])
+        if total > 0:
+            self.positions = np.memmap(os.path.join(path, "positions.u16"), dtype=np.uint16, mode="r", shape=(total, 2))
+        else:
+            self.positions = np.zeros((0, 2), dtype=np.uint16)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def frame(self, k):
+        """
+        Positions of frame k in spawn order, as float32 pixels.
+        """
+        return self.positions[self.offsets[k]:self.offsets[k + 1]].astype(np.float32) / self.scale
+
+    @staticmethod
+    def find(root, key):
+        path = os.path.join(root, key)
+        return TrajectoryReader(path) if os.path.exists(os.path.join(path, "meta.json")) else None
@@ -0,0 +1,98 @@
+import json
+import math
+import platform
+import random
+import statistics
+import time
+import numpy as np
+import pymunk
+from main import PymunkBalls, compute_emission_angle, BALL_SPEED, MIN_BALL_RADIUS, MAX_BALL_RADIUS, NUM_SPOUTS, \
+    FULL_SCREEN_PERCENT, SPACE_ITERATIONS, SPACE_COLLISION_SLOP, SPACE_SLEEP_TIME, SPACE_THREADS
+
+# Benchmark settings
+BENCH_OUTPUT = "space_benchmark.json"
+BENCH_PROFILES = ["default", "fast"]
+BENCH_WIDTH = 960
+BENCH_HEIGHT = 540
+BENCH_SETTLE_FRAMES = 180  # Frames stepped after the last ball is spawned
+BENCH_SEED = 0
+
+def fill_scene(profile):
+    """
+    The fill of runSimulationAndRecord without a window: spouts emit balls
+    until they cover FULL_SCREEN_PERCENT of the screen, then the pile is left
+    to settle. Returns ms per step while filling and while settling, and the
+    state of the pile at the end to compare the profiles' accuracy by.
+    """
+    random.seed(BENCH_SEED)
+    width, height = BENCH_WIDTH, BENCH_HEIGHT
+    balls = PymunkBalls(width, height, profile)
+    emitter_positions = [(int((i+0.5)*width/NUM_SPOUTS), 50) for i in range(NUM_SPOUTS)]
+    fill_threshold = FULL_SCREEN_PERCENT * width * height
+    accumulated_area = 0.0
+    ballCount = 0
+    dt = 1.0/60.0
+    fillTimes = []
+    settleTimes = []
+    while accumulated_area < fill_threshold:
+        for i, emitter in enumerate(emitter_positions):
+            angleRad = math.radians(compute_emission_angle(ballCount, i))
+            radius = random.randint(MIN_BALL_RADIUS, MAX_BALL_RADIUS)
+            accumulated_area += math.pi * (radius**2)
+            balls.add(emitter, (BALL_SPEED * math.cos(angleRad), BALL_SPEED * math.sin(angleRad)), radius,
+                      (0,0,255,255), ballCount)
+            ballCount += 1
+        start = time.perf_counter()
+        balls.step(dt)
+        fillTimes.append(time.perf_counter() - start)
+    for _ in range(BENCH_SETTLE_FRAMES):
+        start = time.perf_counter()
+        balls.step(dt)
+        settleTimes.append(time.perf_counter() - start)
+    positions = balls.positions()
+    radii = balls.radii()
+    return {
+        "profile": profile,
+        "balls": ballCount,
+        "fill_frames": len(fillTimes),
+        "fill_ms": statistics.mean(fillTimes) * 1000,
+        "settle_ms": statistics.mean(settleTimes) * 1000,
+        "total_s": sum(fillTimes) + sum(settleTimes),
+        "rms_speed": balls.rms_speed(),
+        "sleeping": sum(shape.body.is_sleeping for shape in balls.shapes),
+        # Top of the pile, ignoring the few balls still bouncing around
+        "pile_top": float(np.percentile(positions[:, 1] - radii, 1)),
+        "escaped": int(np.count_nonzero((positions[:, 0] < 0) | (positions[:, 0] > width)
+                                        | (positions[:, 1] < 0) | (positions[:, 1] > height))),
+    }
+
+def main():
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pymunk": pymunk.version,
+        "machine": platform.machine(),
+        "resolution": [BENCH_WIDTH, BENCH_HEIGHT],
+        "fast_profile": {"iterations": SPACE_ITERATIONS, "collision_slop": SPACE_COLLISION_SLOP,
+                         "sleep_time": SPACE_SLEEP_TIME, "threads": SPACE_THREADS},
+        "results": [],
+    }
+    for profile in BENCH_PROFILES:
+        result = fill_scene(profile)
+        report["results"].append(result)
+        print(f"{profile:8s} {result['balls']} balls: {result['fill_ms']:.2f} ms per step filling, "
+              f"{result['settle_ms']:.2f} ms settling, {result['total_s']:.1f} s in total; "
+              f"pile top at {result['pile_top']:.1f} px, {result['sleeping']} asleep, "
+              f"{result['escaped']} escaped")
+    baseline = report["results"][0]
+    for result in report["results"][1:]:
+        print(f"{result['profile']} against {baseline['profile']}: "
+              f"{baseline['total_s'] / result['total_s']:.2f}x faster in total, "
+              f"{baseline['settle_ms'] / result['settle_ms']:.2f}x while settling, "
+              f"pile top {result['pile_top'] - baseline['pile_top']:+.1f} px")
+    with open(BENCH_OUTPUT, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {BENCH_OUTPUT}")
+
+if __name__ == "__main__":
+    main()
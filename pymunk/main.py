@@ -1,22 +1,33 @@
 import os
+import sys
 import pygame
-import pygame.gfxdraw
 import pymunk
 import math
-import json
 import random
-import imageio
 import numpy as np
 import string
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "betterversion"))
+from rasterizer import draw_circles, LayeredRenderer
+from sampler import surface_to_array, sample_colors
+from balldata import write_ball_data, load_ball_data, export_json
+from encoder import FramePipeline
+from particles import ParticleStore
+from physicsengine import allocate_grid, step_frame, motion_stats
 
 WINDOW_WIDTH = 1920
 WINDOW_HEIGHT = 1080
 BALL_SPEED = 1000
-SETTLE_DELAY_MS = 3000
+SETTLE_DELAY_MS = 3000  # Longest simulated time the pile is given to come to rest, the same in both phases
+SETTLE_SPEED = 20.0  # RMS ball speed (px/s) below which the pile counts as at rest
+SETTLE_FRAMES = 30  # Consecutive calm frames needed before moving on
 GRAVITY = 900
 MASS = 0.1
-DATA_FILENAME = "ball_data.json"
+DATA_FILENAME = "ball_data.bin"
+EXPORT_JSON = False  # Also write ball_data.json next to the binary file
 MIN_BALL_RADIUS = 3
 MAX_BALL_RADIUS = 10
 FULL_SCREEN_PERCENT = 1.3
@@ -25,6 +36,26 @@ NUM_SPOUTS = 36
 BORDER_THICKNESS = 1
 OSCILLATION_AMPLITUDE_DEG = 40
 OSCILLATION_PERIOD = 5.0
+SAMPLING_MODE = "box"
+SAMPLING_REGION = 1
+BACKGROUND_COLOR = (255, 255, 255)
+BORDER_COLOR = np.array((0, 0, 0), dtype=np.uint8)
+NO_HIDDEN_POINTS = np.zeros((0, 2), dtype=np.float64)
+NO_SPOUTS = np.zeros((0, 2), dtype=np.float32)
+LAYERED_RENDERING = True  # Cache balls that stopped moving in a static layer and only redraw the moving ones
+SPACE_PROFILE = "default"  # "default" keeps pymunk's stock Space; "fast" trades accuracy for speed with the SPACE_* settings below
+SPACE_ITERATIONS = 5  # Solver iterations per step in the "fast" profile (pymunk's default is 10)
+SPACE_COLLISION_SLOP = 0.5  # Overlap in px the "fast" profile leaves unresolved (pymunk's default is 0.1)
+SPACE_SLEEP_TIME = 0.5  # Seconds a body must stay idle before the "fast" profile puts it to sleep
+SPACE_THREADS = 2  # Solver threads of the "fast" profile; pymunk has no threaded solver on Windows
+PHYSICS_BACKEND = "pymunk"  # "pymunk", or "verlet" for the array-based engine of betterversion/physicsengine.py
+VERLET_SUBSTEPS = 8
+VERLET_SLEEP_DISTANCE = 1.0  # As sleepDistance, sleepFrames and wakeDepth in betterversion/main.py
+VERLET_SLEEP_FRAMES = 0
+VERLET_WAKE_DEPTH = 1.0
+VERLET_FILL_PERCENT = 0.75  # Ball area spawned on the verlet backend, as a share of its box; FULL_SCREEN_PERCENT is for pymunk
+RECONSTRUCTION_TOLERANCE = 1.0  # Median distance (px) between phase 1 and phase 2 ball positions above which process_image warns
+BATCH_WORKERS = 0  # Number of images processed in parallel with headless SDL; 0 runs them one by one in this process
 
 def compute_emission_angle(ballNumber, emitter_index):
     batch = ballNumber // NUM_SPOUTS
@@ -34,36 +65,244 @@ def compute_emission_angle(ballNumber, emitter_index):
     osc_offset = OSCILLATION_AMPLITUDE_DEG * math.sin(2 * math.pi * emission_time / OSCILLATION_PERIOD)
     return baseAngle + variation + osc_offset
 
-def runSimulationAndRecord(screen, clock, width, height, image_filename, video_writer=None):
+class PymunkBalls:
+    """
+    Balls as pymunk bodies in a pymunk.Space closed by walls, a floor and a
+    ceiling. Ball state is handed out as arrays built from the shapes.
+
+    The "fast" profile swaps the bounding box tree for a spatial hash with
+    cells one ball across, lets bodies that stay idle fall asleep, runs
+    fewer solver iterations with more slop and uses the threaded solver
+    where pymunk has one.
+    """
+
+    def __init__(self, width, height, profile=SPACE_PROFILE):
+        if profile == "fast":
+            threaded = SPACE_THREADS > 1 and sys.platform != "win32"
+            self.space = pymunk.Space(threaded=threaded)
+            if threaded:
+                self.space.threads = SPACE_THREADS
+            # Sized for the largest ball; about as many buckets as balls that fill the screen
+            cellSize = 2 * MAX_BALL_RADIUS
+            self.space.use_spatial_hash(cellSize, int(FULL_SCREEN_PERCENT * width * height / cellSize ** 2) * 4)
+            self.space.iterations = SPACE_ITERATIONS
+            self.space.collision_slop = SPACE_COLLISION_SLOP
+            self.space.sleep_time_threshold = SPACE_SLEEP_TIME
+        else:
+            self.space = pymunk.Space()
+        self.space.gravity = (0, GRAVITY)
+        floorBody = pymunk.Body(body_type=pymunk.Body.STATIC)
+        floorShape = pymunk.Poly.create_box(floorBody, (width, 20))
+        floorBody.position = (width/2, height-10)
+        floorShape.friction = 1.0
+        floorShape.elasticity = 0.4
+        self.space.add(floorBody, floorShape)
+        leftWall = pymunk.Segment(self.space.static_body, (5,0), (5,height), 5)
+        rightWall = pymunk.Segment(self.space.static_body, (width-5,0), (width-5,height), 5)
+        leftWall.friction = rightWall.friction = 1.0
+        leftWall.elasticity = rightWall.elasticity = 0.4
+        self.space.add(leftWall, rightWall)
+        ceiling = pymunk.Segment(self.space.static_body, (5,5), (width-5,5), 5)
+        ceiling.friction = 1.0
+        ceiling.elasticity = 0.4
+        self.space.add(ceiling)
+        self.shapes = []
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def add(self, position, velocity, radius, color, ballNumber):
+        inertia = pymunk.moment_for_circle(MASS, 0, radius)
+        body = pymunk.Body(MASS, inertia)
+        body.position = position
+        body.velocity = velocity
+        shape = pymunk.Circle(body, radius)
+        shape.friction = 0.5
+        shape.elasticity = 0.4
+        shape.color = tuple(color)
+        shape.ballNumber = ballNumber
+        self.space.add(body, shape)
+        self.shapes.append(shape)
+
+    def step(self, dt):
+        self.space.step(dt)
+
+    def positions(self):
+        return np.array([shape.body.position for shape in self.shapes], dtype=np.float64).reshape(-1, 2)
+
+    def radii(self):
+        return np.array([shape.radius for shape in self.shapes], dtype=np.float64)
+
+    def colors(self):
+        return np.array([shape.color[:3] for shape in self.shapes], dtype=np.uint8).reshape(-1, 3)
+
+    def set_colors(self, colors):
+        for shape, color in zip(self.shapes, colors.tolist()):
+            shape.color = (*color, 255)
+
+    def ball_numbers(self):
+        return np.array([shape.ballNumber for shape in self.shapes], dtype=np.int32)
+
+    def rms_speed(self):
+        if not self.shapes:
+            return 0.0
+        total = 0.0
+        for shape in self.shapes:
+            vx, vy = shape.body.velocity
+            total += vx*vx + vy*vy
+        return math.sqrt(total / len(self.shapes))
+
+    def stop(self):
+        for shape in self.shapes:
+            # Setting the velocity would wake a sleeping body
+            if shape.body.is_sleeping:
+                continue
+            shape.body.velocity = (0,0)
+            shape.body.angular_velocity = 0
+
+class VerletBalls:
+    """
+    The same box on the Verlet engine of betterversion, with ball state kept
+    in a ParticleStore. The engine's box spans from the origin to its size,
+    so coordinates are shifted to put its edges on the inner faces of the
+    pymunk walls (x 10 and width-10, ceiling 10, floor height-20). Balls
+    have equal mass there as here, so only the radii differ between them;
+    the grid cells fit the largest ball. Friction and elasticity are not
+    modelled, so piles behave somewhat differently from the pymunk ones.
+    """
+
+    def __init__(self, width, height, capacity):
+        self.offset = np.array((10, 10), dtype=np.float32)
+        self.width = width - 20
+        self.height = height - 30
+        self.store = ParticleStore(capacity, MAX_BALL_RADIUS)
+        self.count = 0
+        self.dt = 1.0/60.0 / VERLET_SUBSTEPS
+        self.sleepAfter = VERLET_SLEEP_FRAMES * VERLET_SUBSTEPS if VERLET_SLEEP_FRAMES > 0 else np.iinfo(np.int32).max
+        self.cellSize = 2 * MAX_BALL_RADIUS
+        self.cellsX = int(self.width // self.cellSize) + 1
+        self.cellsY = int(self.height // self.cellSize) + 1
+        self.grid = allocate_grid(self.store.capacity, self.cellsX, self.cellsY)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, position, velocity, radius, color, ballNumber):
+        if self.store.reserve(self.count + 1):
+            self.grid = allocate_grid(self.store.capacity, self.cellsX, self.cellsY)
+        store = self.store
+        i = self.count
+        store.pos[i] = np.array(position, dtype=np.float32) - self.offset
+        store.prev[i] = store.pos[i] - np.array(velocity, dtype=np.float32) * self.dt
+        store.anchors[i] = store.pos[i]
+        store.still[i] = 0
+        store.radii[i] = radius
+        store.colors[i] = color[:3]
+        store.ids[i] = ballNumber
+        self.count += 1
+
+    def step(self, dt):
+        # Frames are always 1/60 s long, which self.dt was set up for
+        store = self.store
+        step_frame(store.pos, store.prev, store.radii, store.ids, store.colors, store.anchors, store.still,
+                   self.count, NO_SPOUTS, 0.0, 0.0, 0, 0, store.colors, VERLET_SUBSTEPS, self.dt,
+                   self.width, self.height, GRAVITY, False, VERLET_SLEEP_DISTANCE ** 2, self.sleepAfter,
+                   VERLET_WAKE_DEPTH, self.cellSize, self.cellsX, self.cellsY, *self.grid, True)
+
+    def positions(self):
+        return (self.store.pos[:self.count] + self.offset).astype(np.float64)
+
+    def radii(self):
+        return self.store.radii[:self.count].astype(np.float64)
+
+    def colors(self):
+        return self.store.colors[:self.count]
+
+    def set_colors(self, colors):
+        self.store.colors[:self.count] = colors
+
+    def ball_numbers(self):
+        return self.store.ids[:self.count].copy()
+
+    def rms_speed(self):
+        if self.count == 0:
+            return 0.0
+        total, _ = motion_stats(self.store.pos, self.store.prev, self.count)
+        return math.sqrt(total / self.count) / self.dt
+
+    def stop(self):
+        self.store.prev[:self.count] = self.store.pos[:self.count]
+
+def make_balls(width, height, capacity):
+    if PHYSICS_BACKEND == "verlet":
+        return VerletBalls(width, height, capacity)
+    return PymunkBalls(width, height, SPACE_PROFILE)
+
+def fill_target(width, height):
+    """
+    Ball area phase 1 spawns. pymunk's soft contacts let the pile squeeze
+    well past the screen area; the Verlet engine resolves every overlap, so
+    a pile filled that far never comes to rest and the relaunch cannot
+    land the balls where their colours were sampled.
+    """
+    if PHYSICS_BACKEND == "verlet":
+        return VERLET_FILL_PERCENT * (width - 20) * (height - 30)
+    return FULL_SCREEN_PERCENT * width * height
+
+def positions_by_number(balls):
+    positions = np.empty((len(balls), 2), dtype=np.float64)
+    positions[balls.ball_numbers()] = balls.positions()
+    return positions
+
+def check_reconstruction(image_file, sampled, relaunched):
+    """
+    Compare where each ball was when phase 1 sampled its colour with where
+    the relaunch left it, and warn when the picture came out scrambled.
+    """
+    if len(sampled) != len(relaunched):
+        print(f"{image_file}: WARNING relaunched {len(relaunched)} balls, phase 1 sampled {len(sampled)}")
+        return
+    error = float(np.median(np.hypot(*(relaunched - sampled).T))) if len(sampled) else 0.0
+    if error > RECONSTRUCTION_TOLERANCE:
+        print(f"{image_file}: WARNING relaunched balls are a median {error:.1f} px from where their colours were sampled")
+    else:
+        print(f"{image_file}: relaunched balls are a median {error:.2f} px from where their colours were sampled")
+
+def make_renderer(width, height):
+    if LAYERED_RENDERING:
+        return LayeredRenderer(width, height, BACKGROUND_COLOR, BORDER_THICKNESS, BORDER_COLOR, NO_HIDDEN_POINTS)
+    return None
+
+def draw_balls(frame, balls, renderer):
+    if renderer is not None:
+        renderer.draw(frame, np.round(balls.positions()), np.round(balls.radii()), balls.colors(), len(balls))
+        return
+    frame[:] = BACKGROUND_COLOR
+    if len(balls) == 0:
+        return
+    draw_circles(frame, np.round(balls.positions()), np.round(balls.radii()), balls.colors(), len(balls),
+                 BORDER_THICKNESS, BORDER_COLOR, NO_HIDDEN_POINTS)
+
+def runSimulationAndRecord(screen, clock, width, height, image_filename, video_writer=None, data_filename=DATA_FILENAME):
     originalImage = pygame.image.load(image_filename).convert_alpha()
     imgWidth, imgHeight = originalImage.get_size()
-    space = pymunk.Space()
-    space.gravity = (0, GRAVITY)
-    floorBody = pymunk.Body(body_type=pymunk.Body.STATIC)
-    floorShape = pymunk.Poly.create_box(floorBody, (width, 20))
-    floorBody.position = (width/2, height-10)
-    floorShape.friction = 1.0
-    floorShape.elasticity = 0.4
-    space.add(floorBody, floorShape)
-    leftWall = pymunk.Segment(space.static_body, (5,0), (5,height), 5)
-    rightWall = pymunk.Segment(space.static_body, (width-5,0), (width-5,height), 5)
-    leftWall.friction = rightWall.friction = 1.0
-    leftWall.elasticity = rightWall.elasticity = 0.4
-    space.add(leftWall, rightWall)
-    ceiling = pymunk.Segment(space.static_body, (5,5), (width-5,5), 5)
-    ceiling.friction = 1.0
-    ceiling.elasticity = 0.4
-    space.add(ceiling)
+    imageArray = surface_to_array(originalImage)
+    fill_threshold = fill_target(width, height)
+    # Radii are uniform over MIN_BALL_RADIUS..MAX_BALL_RADIUS
+    meanArea = math.pi * np.mean(np.arange(MIN_BALL_RADIUS, MAX_BALL_RADIUS + 1) ** 2)
+    balls = make_balls(width, height, int(fill_threshold / meanArea) + NUM_SPOUTS)
     emitter_positions = [(int((i+0.5)*width/NUM_SPOUTS), 50) for i in range(NUM_SPOUTS)]
-    ballShapes = []
     ballCount = 0
     settleTimer = None
+    calmFrames = 0
     simulationDone = False
     finalWaitStart = None
+    sampledPositions = None
     accumulated_area = 0.0
-    window_area = width * height
-    fill_threshold = FULL_SCREEN_PERCENT * window_area
     simulation_time = 0.0
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frameSurface = pygame.image.frombuffer(frame, (width, height), "RGB")
+    renderer = make_renderer(width, height)
     while True:
         dt = 1.0/60.0
         simulation_time += dt
@@ -80,62 +319,32 @@ def runSimulationAndRecord(screen, clock, width, height, image_filename, video_w
                     vy = BALL_SPEED * math.sin(angleRad)
                     radius = random.randint(MIN_BALL_RADIUS, MAX_BALL_RADIUS)
                     accumulated_area += math.pi * (radius**2)
-                    inertia = pymunk.moment_for_circle(MASS, 0, radius)
-                    body = pymunk.Body(MASS, inertia)
-                    body.position = emitter
-                    body.velocity = (vx, vy)
-                    shape = pymunk.Circle(body, radius)
-                    shape.friction = 0.5
-                    shape.elasticity = 0.4
-                    shape.color = (0,0,255,255)
-                    shape.ballNumber = ballCount
-                    shape.ballRadius = radius
-                    space.add(body, shape)
-                    ballShapes.append(shape)
+                    balls.add(emitter, (vx, vy), radius, (0,0,255,255), ballCount)
                     ballCount += 1
             else:
+                calmFrames = calmFrames + 1 if balls.rms_speed() < SETTLE_SPEED else 0
                 if settleTimer is None:
-                    settleTimer = pygame.time.get_ticks()
-                elif pygame.time.get_ticks() - settleTimer > SETTLE_DELAY_MS and not simulationDone:
+                    settleTimer = simulation_time
+                elif calmFrames >= SETTLE_FRAMES or (simulation_time - settleTimer) * 1000 > SETTLE_DELAY_MS:
                     simulationDone = True
                     finalWaitStart = pygame.time.get_ticks()
-                    for shape in ballShapes:
-                        pos = shape.body.position
-                        relX = max(0, min(1, pos.x/width))
-                        relY = max(0, min(1, pos.y/height))
-                        imgX = int(relX*(imgWidth-1))
-                        imgY = int(relY*(imgHeight-1))
-                        totalR = totalG = totalB = count = 0
-                        region = 1
-                        for ix in range(imgX-region, imgX+region+1):
-                            for iy in range(imgY-region, imgY+region+1):
-                                if 0 <= ix < imgWidth and 0 <= iy < imgHeight:
-                                    col = originalImage.get_at((ix,iy))
-                                    totalR += col.r
-                                    totalG += col.g
-                                    totalB += col.b
-                                    count += 1
-                        avgColor = (totalR//count, totalG//count, totalB//count, 255) if count else (0,0,0,255)
-                        shape.color = avgColor
-                    ballData = []
-                    for shape in ballShapes:
-                        ballData.append({"ballNumber": shape.ballNumber, "color": list(shape.color), "radius": shape.ballRadius})
-                    with open(DATA_FILENAME, "w") as f:
-                        json.dump(ballData, f, indent=2)
+                    positions = balls.positions()
+                    radii = balls.radii()
+                    imgX = (np.clip(positions[:, 0]/width, 0, 1)*(imgWidth-1)).astype(int)
+                    imgY = (np.clip(positions[:, 1]/height, 0, 1)*(imgHeight-1)).astype(int)
+                    sampled = sample_colors(imageArray, imgX, imgY, SAMPLING_MODE, half_size=SAMPLING_REGION,
+                                            radii=radii*imgWidth/width)
+                    balls.set_colors(sampled)
+                    sampledPositions = positions_by_number(balls)
+                    write_ball_data(data_filename, balls.ball_numbers(), radii, balls.colors())
+                    if EXPORT_JSON:
+                        export_json(os.path.splitext(data_filename)[0] + ".json", load_ball_data(data_filename))
         else:
-            if finalWaitStart is not None and pygame.time.get_ticks() - finalWaitStart > FINAL_WAIT_MS:
+            # Nothing is recorded here, so stop as soon as the coloured pile is at rest
+            if balls.rms_speed() < SETTLE_SPEED or pygame.time.get_ticks() - finalWaitStart > FINAL_WAIT_MS:
                 break
-        space.step(dt)
-        screen.fill((255,255,255))
-        for shape in ballShapes:
-            pos = shape.body.position
-            x = int(round(pos.x))
-            y = int(round(pos.y))
-            r = int(round(shape.radius))
-            if -32768 <= x <= 32767 and -32768 <= y <= 32767 and 0 <= r <= 32767:
-                pygame.gfxdraw.filled_circle(screen, x, y, r, shape.color[:3])
-                if BORDER_THICKNESS > 0:
-                    pygame.draw.circle(screen, (0,0,0), (x,y), r, BORDER_THICKNESS)
+        balls.step(dt)
+        draw_balls(frame, balls, renderer)
         for i, emitter in enumerate(emitter_positions):
             ex, ey = emitter
             baseAngle = 45 if i < NUM_SPOUTS//2 else 135
@@ -148,44 +357,34 @@ def runSimulationAndRecord(screen, clock, width, height, image_filename, video_w
             perp = (-math.sin(angleRad), math.cos(angleRad))
             base_left = (ex + half_width * perp[0], ey + half_width * perp[1])
             base_right = (ex - half_width * perp[0], ey - half_width * perp[1])
-            pygame.draw.polygon(screen, (255,0,0), [base_left, base_right, tip])
-            pygame.draw.circle(screen, (0,255,0), (int(round(tip[0])), int(round(tip[1]))), 5)
+            pygame.draw.polygon(frameSurface, (255,0,0), [base_left, base_right, tip])
+            pygame.draw.circle(frameSurface, (0,255,0), (int(round(tip[0])), int(round(tip[1]))), 5)
+            if renderer is not None:
+                xs = (base_left[0], base_right[0], tip[0])
+                ys = (base_left[1], base_right[1], tip[1])
+                renderer.invalidate(min(xs) - 6, min(ys) - 6, max(xs) + 7, max(ys) + 7)
+        screen.blit(frameSurface, (0, 0))
         pygame.display.flip()
         if video_writer is not None:
-            frame = pygame.surfarray.array3d(screen)
-            frame = np.transpose(frame, (1,0,2))
-            video_writer.append_data(frame)
+            video_writer.submit(frame)
         clock.tick(60)
     pygame.quit()
+    return sampledPositions
 
-def runRelaunchSimulation(screen, clock, width, height, video_writer):
-    with open(DATA_FILENAME, "r") as f:
-        ballData = json.load(f)
+def runRelaunchSimulation(screen, clock, width, height, video_writer, data_filename=DATA_FILENAME):
+    ballData = load_ball_data(data_filename)
     totalBalls = len(ballData)
-    space = pymunk.Space()
-    space.gravity = (0, GRAVITY)
-    floorBody = pymunk.Body(body_type=pymunk.Body.STATIC)
-    floorShape = pymunk.Poly.create_box(floorBody, (width, 20))
-    floorBody.position = (width/2, height-10)
-    floorShape.friction = 1.0
-    floorShape.elasticity = 0.4
-    space.add(floorBody, floorShape)
-    leftWall = pymunk.Segment(space.static_body, (5,0), (5,height), 5)
-    rightWall = pymunk.Segment(space.static_body, (width-5,0), (width-5,height), 5)
-    leftWall.friction = rightWall.friction = 1.0
-    leftWall.elasticity = rightWall.elasticity = 0.4
-    space.add(leftWall, rightWall)
-    ceiling = pymunk.Segment(space.static_body, (5,5), (width-5,5), 5)
-    ceiling.friction = 1.0
-    ceiling.elasticity = 0.4
-    space.add(ceiling)
+    balls = make_balls(width, height, totalBalls)
     emitter_positions = [(int((i+0.5)*width/NUM_SPOUTS), 50) for i in range(NUM_SPOUTS)]
-    ballShapes = []
     ballIndex = 0
     settleTimer = None
+    calmFrames = 0
     simulationDone = False
     finalWaitStart = None
     simulation_time = 0.0
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frameSurface = pygame.image.frombuffer(frame, (width, height), "RGB")
+    renderer = make_renderer(width, height)
     while True:
         dt = 1.0/60.0
         simulation_time += dt
@@ -198,50 +397,29 @@ def runRelaunchSimulation(screen, clock, width, height, video_writer):
                 if ballIndex >= totalBalls:
                     break
                 data = ballData[ballIndex]
-                emitter_index = data["ballNumber"] % NUM_SPOUTS
+                ballNumber = int(data["ballNumber"])
+                emitter_index = ballNumber % NUM_SPOUTS
                 emitter = emitter_positions[emitter_index]
-                angleDeg = compute_emission_angle(data["ballNumber"], emitter_index)
+                angleDeg = compute_emission_angle(ballNumber, emitter_index)
                 angleRad = math.radians(angleDeg)
                 vx = BALL_SPEED * math.cos(angleRad)
                 vy = BALL_SPEED * math.sin(angleRad)
-                radius = data["radius"]
-                inertia = pymunk.moment_for_circle(MASS, 0, radius)
-                body = pymunk.Body(MASS, inertia)
-                body.position = emitter
-                body.velocity = (vx, vy)
-                shape = pymunk.Circle(body, radius)
-                shape.friction = 0.5
-                shape.elasticity = 0.4
-                shape.color = tuple(data["color"])
-                shape.ballNumber = data["ballNumber"]
-                shape.ballRadius = radius
-                space.add(body, shape)
-                ballShapes.append(shape)
+                balls.add(emitter, (vx, vy), float(data["radius"]), data["color"].tolist(), ballNumber)
                 ballIndex += 1
-        else:
+        elif not simulationDone:
+            calmFrames = calmFrames + 1 if balls.rms_speed() < SETTLE_SPEED else 0
             if settleTimer is None:
-                settleTimer = pygame.time.get_ticks()
-            elif not simulationDone and pygame.time.get_ticks() - settleTimer > SETTLE_DELAY_MS:
+                settleTimer = simulation_time
+            elif calmFrames >= SETTLE_FRAMES or (simulation_time - settleTimer) * 1000 > SETTLE_DELAY_MS:
                 simulationDone = True
                 finalWaitStart = pygame.time.get_ticks()
-                for shape in ballShapes:
-                    shape.body.velocity = (0,0)
-                    shape.body.angular_velocity = 0
+                balls.stop()
         if not simulationDone:
-            space.step(dt)
+            balls.step(dt)
         else:
             if finalWaitStart is not None and pygame.time.get_ticks() - finalWaitStart > FINAL_WAIT_MS:
                 break
-        screen.fill((255,255,255))
-        for shape in ballShapes:
-            pos = shape.body.position
-            x = int(round(pos.x))
-            y = int(round(pos.y))
-            r = int(round(shape.radius))
-            if -32768 <= x <= 32767 and -32768 <= y <= 32767 and 0 <= r <= 32767:
-                pygame.gfxdraw.filled_circle(screen, x, y, r, shape.color[:3])
-                if BORDER_THICKNESS > 0:
-                    pygame.draw.circle(screen, (0,0,0), (x,y), r, BORDER_THICKNESS)
+        draw_balls(frame, balls, renderer)
         for i, emitter in enumerate(emitter_positions):
             ex, ey = emitter
             baseAngle = 45 if i < NUM_SPOUTS//2 else 135
@@ -254,48 +432,92 @@ def runRelaunchSimulation(screen, clock, width, height, video_writer):
             perp = (-math.sin(angleRad), math.cos(angleRad))
             base_left = (ex + half_width * perp[0], ey + half_width * perp[1])
             base_right = (ex - half_width * perp[0], ey - half_width * perp[1])
-            pygame.draw.polygon(screen, (255,0,0), [base_left, base_right, tip])
-            pygame.draw.circle(screen, (0,255,0), (int(round(tip[0])), int(round(tip[1]))), 5)
+            pygame.draw.polygon(frameSurface, (255,0,0), [base_left, base_right, tip])
+            pygame.draw.circle(frameSurface, (0,255,0), (int(round(tip[0])), int(round(tip[1]))), 5)
+            if renderer is not None:
+                xs = (base_left[0], base_right[0], tip[0])
+                ys = (base_left[1], base_right[1], tip[1])
+                renderer.invalidate(min(xs) - 6, min(ys) - 6, max(xs) + 7, max(ys) + 7)
+        screen.blit(frameSurface, (0, 0))
         pygame.display.flip()
-        frame = pygame.surfarray.array3d(screen)
-        frame = np.transpose(frame, (1,0,2))
-        video_writer.append_data(frame)
+        video_writer.submit(frame)
         clock.tick(60)
     pygame.quit()
+    return positions_by_number(balls)
 
 def get_image_files():
     exts = ('.png','.jpg','.jpeg')
     return [f for f in os.listdir('.') if os.path.isfile(f) and f.lower().endswith(exts)]
 
-def get_next_dir():
+def publish_dir(staging_dir):
+    """
+    Move a finished staging directory to the next free numbered folder.
+    The rename is atomic and fails if another run claimed the name first,
+    in which case the next number is tried.
+    """
     i = 1
-    while os.path.exists(str(i)):
+    while True:
+        dest_dir = str(i)
+        if not os.path.exists(dest_dir):
+            try:
+                os.rename(staging_dir, dest_dir)
+                return dest_dir
+            except OSError:
+                pass
         i += 1
-    return str(i)
 
 def process_image(image_file):
-    pygame.init()
-    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-    clock = pygame.time.Clock()
-    runSimulationAndRecord(screen, clock, WINDOW_WIDTH, WINDOW_HEIGHT, image_file, video_writer=None)
-    pygame.init()
-    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-    clock = pygame.time.Clock()
-    video_hash = "".join(random.choices(string.ascii_lowercase+string.digits, k=6))
-    video_filename = f"{video_hash}.mp4"
-    video_writer = imageio.get_writer(video_filename, fps=60)
-    runRelaunchSimulation(screen, clock, WINDOW_WIDTH, WINDOW_HEIGHT, video_writer)
-    video_writer.close()
-    if os.path.exists(DATA_FILENAME):
-        os.remove(DATA_FILENAME)
-    dest_dir = get_next_dir()
-    os.makedirs(dest_dir)
-    shutil.move(image_file, os.path.join(dest_dir, image_file))
-    shutil.move(video_filename, os.path.join(dest_dir, video_filename))
+    # Every run works in a private staging folder so concurrent runs never
+    # share ball data or video files.
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=".")
+    try:
+        data_filename = os.path.join(staging_dir, DATA_FILENAME)
+        pygame.init()
+        screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        clock = pygame.time.Clock()
+        sampledPositions = runSimulationAndRecord(screen, clock, WINDOW_WIDTH, WINDOW_HEIGHT, image_file,
+                                                  video_writer=None, data_filename=data_filename)
+        pygame.init()
+        screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        clock = pygame.time.Clock()
+        video_hash = "".join(random.choices(string.ascii_lowercase+string.digits, k=6))
+        video_filename = f"{video_hash}.mp4"
+        video_writer = FramePipeline(os.path.join(staging_dir, video_filename), WINDOW_WIDTH, WINDOW_HEIGHT, fps=60)
+        relaunchedPositions = runRelaunchSimulation(screen, clock, WINDOW_WIDTH, WINDOW_HEIGHT, video_writer,
+                                                    data_filename=data_filename)
+        video_writer.close()
+        if sampledPositions is not None and relaunchedPositions is not None:
+            check_reconstruction(image_file, sampledPositions, relaunchedPositions)
+        if os.path.exists(data_filename):
+            os.remove(data_filename)
+        shutil.move(image_file, os.path.join(staging_dir, image_file))
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    return publish_dir(staging_dir)
+
+def init_batch_worker():
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    random.seed()
+
+def process_batch(image_files, workers):
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as pool:
+        futures = {pool.submit(process_image, image_file): image_file for image_file in image_files}
+        for future in as_completed(futures):
+            image_file = futures[future]
+            try:
+                print(f"{image_file} -> {future.result()}")
+            except Exception as e:
+                print(f"{image_file} failed: {e!r}")
 
 def main():
-    for image_file in get_image_files():
-        process_image(image_file)
+    image_files = get_image_files()
+    if BATCH_WORKERS > 0:
+        process_batch(image_files, BATCH_WORKERS)
+    else:
+        for image_file in image_files:
+            process_image(image_file)
 
 if __name__ == "__main__":
     main()